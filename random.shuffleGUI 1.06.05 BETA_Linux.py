@@ -2,18 +2,66 @@ import os
 import sys
 import datetime
 import time
-import tkinter as tk
-from tkinter import filedialog, messagebox
 import random
 import json
 import subprocess
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-import webbrowser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from array import array
 import threading
-
-# Ensure required packages are installed
-required_packages = ['pygame', 'tkinterdnd2', 'mutagen']
+import sqlite3
+import queue
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import Counter, deque
+import argparse
+import signal
+import stat
+import contextlib
+import tempfile
+import shutil
+import importlib.util
+import hashlib
+import mmap
+import itertools
+import logging
+import logging.handlers
+import atexit
+
+STARTUP_STARTED = time.perf_counter()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Randomly play music from your own local music library")
+    parser.add_argument("--headless", action="store_true",
+                        help="play without a window, using only the mixer and an event loop")
+    parser.add_argument("--music-dir", help="directory to play from instead of the default library")
+    parser.add_argument("--control-socket", metavar="PATH", help="accept JSON commands on this Unix domain socket")
+    parser.add_argument("--control-port", type=int, metavar="PORT", help="accept JSON commands over HTTP on 127.0.0.1:PORT")
+    parser.add_argument("--benchmark", nargs="?", const="1000,100000,1000000", metavar="SIZES",
+                        help="time scanning, selection, rendering, search and persistence on synthetic libraries "
+                             "of the given comma-separated sizes and print the results as JSON")
+    parser.add_argument("--instrument", action="store_true", help="record latency histograms from startup")
+    parser.add_argument("--check-deps", action="store_true", help="install any missing packages and exit")
+    parser.add_argument("--console-level", choices=["debug", "info", "warning", "error"], default="info",
+                        help="least severe console messages to show; debug adds the once-a-second info line")
+    parser.add_argument("--quiet", action="store_true", help="only show warnings and errors on the console")
+    parser.add_argument("--console-rate", type=int, default=5, metavar="LINES",
+                        help="most console lines per second, 0 for no limit (warnings and errors always show)")
+    return parser.parse_args()
+
+args = parse_args()
+if args.headless or args.benchmark:
+    # SDL still needs a video driver to deliver end-of-track events
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+if args.benchmark:
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+
+# Installed on request by --check-deps
+required_packages = ['pygame', 'mutagen'] if args.headless or args.benchmark else ['pygame', 'tkinterdnd2', 'mutagen']
 
 def install_and_import(package):
     try:
@@ -21,32 +69,40 @@ def install_and_import(package):
     except ImportError:
         subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
-for package in required_packages:
-    install_and_import(package)
-
-from tkinterdnd2 import TkinterDnD, DND_FILES
-import pygame
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
-
 # Constants
 REQUIRED_PYTHON_VERSION = (3, 6)
 LOG_FILE = os.path.join(os.path.expanduser("~"), "script_log.txt")
 SETTINGS_FILE = os.path.join(os.path.expanduser("~"), "music_player_settings.json")
+LIBRARY_DB_FILE = os.path.join(os.path.expanduser("~"), "music_library.db")
+PLAYLIST_FILE = os.path.join(os.path.expanduser("~"), "music_playlist.json")
+FEATURES_FILE = os.path.join(os.path.expanduser("~"), "music_features.f32")
+PLAY_LOG_FILE = os.path.join(os.path.expanduser("~"), "music_plays.log")
+DOCUMENTS_DIR = os.path.join(os.path.expanduser("~"), "Documents")
 ORIGINAL_TITLE = "random.shuffleGUI 1.06.05 BETA"
 
-# Initialize Pygame mixer
-pygame.mixer.init()
+def init_audio():
+    global pygame, MUSIC_END, gapless_enabled
+    import pygame
+    pygame.mixer.init()
+    MUSIC_END = pygame.USEREVENT + 1
+    try:
+        # End-of-track events go through SDL's event queue, which lives in the video subsystem
+        pygame.display.init()
+        pygame.mixer.music.set_endevent(MUSIC_END)
+        gapless_enabled = True
+    except pygame.error:
+        gapless_enabled = False
+    mark_startup("audio")
 
 # Global variables
+root = None
 current_dir = None
-song_files = []
+song_files = array('I')
 current_song = None
 song_count = 0
 skip_count = 0
 start_time = None
-prev_songs = []
-playlist = []
+playlist = array('I')
 repeat_enabled = False
 music_paused = False
 playlist_only_mode = False
@@ -56,18 +112,333 @@ volume_level = 50
 auto_save_job = None
 reset_status_job = None
 playlist_modified = False
+watch_library_enabled = False
+normalize_enabled = False
+skip_duplicates_enabled = False
+smart_shuffle_enabled = False
+feature_index = None
+feature_generation = 0
+duplicate_tracks = set()
+duplicate_generation = 0
+closing = False
+track_gain = 1.0
+loudness_generation = 0
+analysis_executor = None
+library_watcher = None
+library_events_job = None
+playlist_revision = 0
+playlist_rendered = None
+playlist_rows = []
+playlist_rows_top = 0
+playlist_view_top = 0
+playlist_selected = None
+playlist_search_term = ""
+playlist_line_height = 16
+search_job = None
+search_generation = 0
+metadata_cache = {}
+# The UI thread fills and evicts the cache while metadata workers invalidate it
+metadata_cache_lock = threading.Lock()
+metadata_pending = set()
+# Paths whose lookup failed, not retried until the next song starts
+metadata_failed = set()
+metadata_conn = None
+metadata_generation = 0
+next_song = None
+# The (bag, index, epoch) draws behind next_song, put back if it is replaced
+next_song_draws = []
+queued_song = None
+next_song_generation = 0
+library_generation = 0
+library_loading = False
+control_servers = []
+control_subscribers = set()
+state_broadcast_pending = False
+instrumentation_enabled = args.instrument
+startup_phases = {}
+startup_reported = False
+gapless_enabled = False
+
+PLAYLIST_VISIBLE_ROWS = 20
+SEARCH_DEBOUNCE_MS = 200
+METADATA_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+METADATA_BATCH = 256
+# Files stat'ed between checks for a newer pass or the window closing
+LIBRARY_STAT_BATCH = 256
+METADATA_CACHE_SIZE = 4096
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+HASH_HEAD_BYTES = 64 * 1024
+HASH_CHUNK = 1024 * 1024
+# Files hashed between checks for a newer scan or the window closing
+HASH_BATCH = 64
+# Tracks are brought to the ReplayGain 2.0 reference level, never past clipping
+LOUDNESS_TARGET_LUFS = -18.0
+LOUDNESS_RATE = 48000
+LOUDNESS_SEGMENT = LOUDNESS_RATE // 10
+LOUDNESS_READ_SEGMENTS = 100
+ANALYSIS_WORKERS = os.cpu_count() or 1
+# Niceness of the thread and worker processes that run the library passes
+LIBRARY_PASS_NICENESS = 10
+# Smart shuffle describes each track by its first two minutes of mono audio,
+# cut into 512-sample frames
+FEATURE_RATE = 22050
+FEATURE_FRAME = 512
+FEATURE_SECONDS = 120
+FEATURE_DIMS = 8
+FEATURE_PUBLISH_EVERY = 1000
+FEATURE_QUERY_BLOCK = 65536
+SMART_NEIGHBOURS = 20
+SMART_HISTORY = 50
+# ITU-R BS.1770 K-weighting at 48 kHz: a high shelf followed by a high pass
+K_WEIGHTING_FILTERS = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+PREFETCH_CHUNK = 1024 * 1024
+PREFETCH_LIMIT = 64 * 1024 * 1024
+SETTINGS_SAVE_DELAY_MS = 1000
+PLAYLIST_JOURNAL_LIMIT = 1000
+# Plays kept in the history table, and how many of the newest stay in memory
+HISTORY_LIMIT = 10000
+HISTORY_MEMORY = 256
+# Play log records are folded into the summary tables this often, and read
+# this many at a time
+PLAY_STATS_BATCH = 100
+PLAY_STATS_CHUNK = 65536
+CONTROL_LINE_LIMIT = 1024 * 1024
+CONTROL_BUFFER_LIMIT = 1024 * 1024
+LATENCY_WINDOW = 1024
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+LATENCY_METRICS = {
+    "update_labels": "Time spent in one update_labels clock tick",
+    "update_playlist": "Time spent redrawing the playlist view",
+    "skip_to_audio": "Time from skip_song to pygame.mixer.music.play returning",
+    "library_scan": "Time spent scanning a music directory",
+    "settings_write": "Time spent writing the settings file",
+    "playlist_write": "Time spent writing the playlist journal or snapshot"
+}
 
 SUPPORTED_FORMATS = ('.mp3', '.wav', '.flac', '.m4a', '.m4b', '.m4p', '.mpc', '.ogg', '.oga', '.mogg', '.raw', '.wma', '.wv', '.webm', '.cda', '.3gp', '.aa', '.aac', '.aax', '.alac', '.aiff', '.dsd', '.mqa')
 VIDEO_FORMATS = ('.mp4', '.mkv', '.webm', '.vob', '.avi', '.wmv', '.m2ts', '.ts', '.m4v')
 
-executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Linux niceness is per thread, so this leaves the rest of the player alone
+def lower_thread_priority():
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), LIBRARY_PASS_NICENESS)
+    except (AttributeError, OSError):
+        pass
 
-def print_and_flush(message):
-    print(message, flush=True)
+def lower_process_priority():
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, LIBRARY_PASS_NICENESS)
+    except (AttributeError, OSError):
+        pass
 
-def log_to_file(message):
-    with open(LOG_FILE, "a") as file:
-        file.write(message + "\n")
+executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+# Whole-library passes (tags, loudness, duplicates, features) queue up on one
+# low-priority thread and stop when their generation moves on, so the shared
+# pool stays free for scans, prefetches and settings writes
+library_pass_executor = ThreadPoolExecutor(max_workers=1, initializer=lower_thread_priority)
+# Every search index update and query goes through this one thread, in order
+search_executor = ThreadPoolExecutor(max_workers=1)
+metadata_executor = ThreadPoolExecutor(max_workers=METADATA_WORKERS)
+# hashlib lets go of the GIL while it digests large buffers, so threads hash in parallel
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+# Playlist journal writes and compactions go through this one thread, in order
+playlist_executor = ThreadPoolExecutor(max_workers=1)
+# Playback history writes and lookups, in order, on the thread that owns its connection
+history_executor = ThreadPoolExecutor(max_workers=1)
+# The same for the play log and its summaries
+stats_executor = ThreadPoolExecutor(max_workers=1)
+
+# One event loop for the whole session, pumped from the Tk main loop so that
+# coroutines run on the Tk thread and can touch widgets directly. Headless
+# mode has no Tk and simply runs the loop forever.
+event_loop = asyncio.new_event_loop()
+asyncio.set_event_loop(event_loop)
+EVENT_LOOP_PUMP_MS = 10
+# With no task in flight the pump only wakes for the loop's next timer, or
+# this often so new control connections are still accepted
+EVENT_LOOP_IDLE_MS = 250
+event_loop_job = None
+# End-of-track events are picked up this often while a track plays; paused or
+# stopped, the mixer is looked at once a second, which is also as often as a
+# stalled mixer is retried
+MUSIC_EVENT_POLL_MS = 50
+MUSIC_EVENT_IDLE_POLL_MS = 1000
+IDLE_SKIP_INTERVAL = 1.0
+idle_skip_task = None
+idle_skip_at = None
+repaint_job = None
+
+# Directory scans are I/O bound, so they get more workers than there are cores
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+SCAN_SPLIT_DEPTH = 3
+SCAN_BATCH_SIZE = 5000
+SCAN_BATCH_INTERVAL = 0.25
+# Marks a free slot in the track store's hash table, which starts this big
+TRACK_SLOT_EMPTY = 0xFFFFFFFF
+TRACK_SLOTS_INITIAL = 8
+scan_workers = SCAN_WORKERS
+shuffle_seed = None
+settings_dirty = False
+settings_save_job = None
+settings_version = 0
+settings_written_version = 0
+settings_lock = threading.Lock()
+
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+# Log calls only put a record on this queue; one listener thread does the
+# formatting, the file writes and the rotation
+log_queue = queue.SimpleQueue()
+log_listener = None
+log_pid = None
+file_logger = logging.getLogger("random.shuffleGUI")
+console_logger = logging.getLogger("random.shuffleGUI.console")
+for queue_logger in (file_logger, console_logger):
+    queue_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    queue_logger.setLevel(logging.DEBUG)
+    queue_logger.propagate = False
+
+# Warnings and errors always get through; anything past the limit within the
+# same second is dropped and counted on the next line that is shown
+class ConsoleRateLimit(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.second = None
+        self.sent = 0
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        second = int(time.monotonic())
+        if second != self.second:
+            self.second = second
+            self.sent = 0
+        if self.sent >= self.rate:
+            self.dropped += 1
+            return False
+        self.sent += 1
+        if self.dropped:
+            record.msg = f"({self.dropped} lines skipped) {record.msg}"
+            self.dropped = 0
+        return True
+
+def setup_logging():
+    global log_listener, log_pid
+    stop_logging()
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                        encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    file_handler.addFilter(lambda record: record.name == file_logger.name)
+    # The benchmark keeps stdout for its JSON report
+    console_handler = logging.StreamHandler(sys.stderr if args.benchmark else sys.stdout)
+    console_handler.setLevel(logging.WARNING if args.quiet else args.console_level.upper())
+    console_handler.addFilter(lambda record: record.name == console_logger.name)
+    if args.console_rate > 0:
+        console_handler.addFilter(ConsoleRateLimit(args.console_rate))
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+    log_pid = os.getpid()
+
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            handler.close()
+        log_listener = None
+
+atexit.register(stop_logging)
+
+# Before setup_logging, and in the analysis worker processes, which have no
+# listener of their own, these fall back to writing directly
+def print_and_flush(message, level=logging.INFO):
+    if log_pid == os.getpid():
+        console_logger.log(level, message)
+    else:
+        print(message, flush=True)
+
+def log_to_file(message, level=logging.ERROR):
+    if log_pid == os.getpid():
+        file_logger.log(level, message)
+    else:
+        with open(LOG_FILE, "a") as file:
+            file.write(message + "\n")
+
+# Keeps the last LATENCY_WINDOW samples for percentiles and buckets, plus
+# lifetime totals. Samples come from worker threads as well as the UI thread.
+class LatencyHistogram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = deque(maxlen=LATENCY_WINDOW)
+            self.count = 0
+            self.total = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            summary = {"count": self.count, "sum_s": round(self.total, 6), "window": len(samples)}
+        if samples:
+            for name, q in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                summary[name] = round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+            summary["max_ms"] = round(samples[-1] * 1000, 3)
+            buckets = {}
+            position = 0
+            for bound in LATENCY_BUCKETS_MS:
+                while position < len(samples) and samples[position] * 1000 <= bound:
+                    position += 1
+                buckets[str(bound)] = position
+            buckets["+Inf"] = len(samples)
+            summary["buckets_ms"] = buckets
+        return summary
+
+latency_histograms = {name: LatencyHistogram() for name in LATENCY_METRICS}
+
+# Call sites only read the clock when instrumentation_enabled is set, so a
+# disabled build pays one global lookup per measured spot
+def record_latency(name, started):
+    latency_histograms[name].record(time.perf_counter() - started)
+
+def metrics_snapshot():
+    return {name: histogram.summary() for name, histogram in latency_histograms.items()}
+
+def metrics_prometheus():
+    lines = []
+    for name, summary in metrics_snapshot().items():
+        metric = f"random_shuffle_{name}_seconds"
+        lines.append(f"# HELP {metric} {LATENCY_METRICS[name]}")
+        lines.append(f"# TYPE {metric} summary")
+        for label, key in (("0.5", "p50_ms"), ("0.9", "p90_ms"), ("0.99", "p99_ms")):
+            if key in summary:
+                lines.append(f'{metric}{{quantile="{label}"}} {summary[key] / 1000}')
+        lines.append(f"{metric}_sum {summary['sum_s']}")
+        lines.append(f"{metric}_count {summary['count']}")
+    return "\n".join(lines) + "\n"
+
+def mark_startup(phase, final=False):
+    global startup_reported
+    if startup_reported or phase in startup_phases:
+        return
+    startup_phases[phase] = round(time.perf_counter() - STARTUP_STARTED, 3)
+    if final and not args.benchmark:
+        startup_reported = True
+        report = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in startup_phases.items())
+        print_and_flush(f"Startup: {report}")
+        log_to_file(f"Startup: {report}", logging.INFO)
 
 def check_python_version():
     if sys.version_info < REQUIRED_PYTHON_VERSION:
@@ -78,82 +449,1413 @@ def check_pygame_installation():
         import pygame
         print_and_flush("pygame is installed.")
     except ImportError:
-        log_to_file("pygame is not installed. Please install it manually using 'pip install pygame'.")
+        log_to_file("pygame is not installed. Please install it manually using 'pip install pygame'.", logging.WARNING)
 
 def check_tkinterdnd2_installation():
     try:
         import tkinterdnd2
         print_and_flush("tkinterdnd2 is installed.")
     except ImportError:
-        log_to_file("tkinterdnd2 is not installed. Please install it manually using 'pip install tkinterdnd2'.")
+        log_to_file("tkinterdnd2 is not installed. Please install it manually using 'pip install tkinterdnd2'.", logging.WARNING)
         
 def check_mutagen_installation():
     try:
         import mutagen
         print_and_flush("mutagen is installed.")
     except ImportError:
-        log_to_file("mutagen is not installed. Please install it manually using 'pip install mutagen'.")
+        log_to_file("mutagen is not installed. Please install it manually using 'pip install mutagen'.", logging.WARNING)
+
+def check_dependencies():
+    for package in required_packages:
+        install_and_import(package)
+    check_pygame_installation()
+    if 'tkinterdnd2' in required_packages:
+        check_tkinterdnd2_installation()
+    check_mutagen_installation()
 
 def load_settings():
-    global volume_level, current_song, playlist
+    global volume_level, current_song, playlist, scan_workers, watch_library_enabled, shuffle_seed, normalize_enabled, skip_duplicates_enabled, smart_shuffle_enabled
+    legacy_playlist = None
     if os.path.exists(SETTINGS_FILE):
         with open(SETTINGS_FILE, 'r') as f:
             settings = json.load(f)
             volume_level = settings.get("volume", 50)
             current_song = settings.get("last_played", None)
-            playlist = settings.get("playlist", [])
+            legacy_playlist = settings.get("playlist")
+            scan_workers = settings.get("scan_workers", SCAN_WORKERS)
+            watch_library_enabled = settings.get("watch_library", False)
+            normalize_enabled = settings.get("normalize_volume", False)
+            skip_duplicates_enabled = settings.get("skip_duplicates", False)
+            smart_shuffle_enabled = settings.get("smart_shuffle", False)
+            shuffle_seed = settings.get("shuffle_seed", None)
+            set_shuffle_seed(shuffle_seed)
+            if root is not None:
+                watch_library_button.config(text="Watch Dir: On" if watch_library_enabled else "Watch Dir: Off", fg="green" if watch_library_enabled else "white")
+                normalize_button.config(text="Normalize: On" if normalize_enabled else "Normalize: Off", fg="green" if normalize_enabled else "white")
+                skip_duplicates_button.config(text="Skip Duplicates: On" if skip_duplicates_enabled else "Skip Duplicates: Off", fg="green" if skip_duplicates_enabled else "white")
+                smart_shuffle_button.config(text="Smart Shuffle: On" if smart_shuffle_enabled else "Smart Shuffle: Off", fg="green" if smart_shuffle_enabled else "white")
             set_volume(volume_level)
-            update_playlist()
     else:
         save_settings()
-
-def save_settings():
-    global volume_level, current_song, playlist
-    settings = {
+    migrate_playlist = legacy_playlist and not os.path.exists(PLAYLIST_FILE)
+    playlist, entries = playlist_journal.read()
+    playlist_journal.attach(playlist, entries)
+    if migrate_playlist:
+        # Playlists used to be stored in the settings file
+        edit_playlist("reset", array('I', map(track_id, legacy_playlist)))
+    playlist_changed()
+
+def settings_snapshot():
+    return {
         "volume": volume_level,
         "last_played": current_song,
-        "playlist": playlist
+        "scan_workers": scan_workers,
+        "watch_library": watch_library_enabled,
+        "normalize_volume": normalize_enabled,
+        "skip_duplicates": skip_duplicates_enabled,
+        "smart_shuffle": smart_shuffle_enabled,
+        "shuffle_seed": shuffle_seed
     }
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f)
+
+def write_file_atomically(path, text):
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+
+def write_settings_file(settings, version):
+    global settings_written_version
+    with settings_lock:
+        if version <= settings_written_version:
+            return
+        started = time.perf_counter() if instrumentation_enabled else None
+        try:
+            write_file_atomically(SETTINGS_FILE, json.dumps(settings))
+            settings_written_version = version
+            if started is not None:
+                record_latency("settings_write", started)
+        except OSError as e:
+            log_to_file(f"Error saving settings: {str(e)}")
+
+# Callers only mark the settings dirty; one write per SETTINGS_SAVE_DELAY_MS
+# goes out on a worker thread, atomically through a temp file and a rename.
+# Pending playlist journal entries are written out on the same schedule.
+def save_settings():
+    global settings_dirty
+    settings_dirty = True
+    schedule_settings_flush()
+
+def schedule_settings_flush():
+    global settings_save_job
+    if settings_save_job is None:
+        settings_save_job = schedule_call(SETTINGS_SAVE_DELAY_MS, flush_settings)
+
+def flush_settings():
+    global settings_dirty, settings_save_job, settings_version
+    settings_save_job = None
+    playlist_journal.flush(playlist)
+    if not settings_dirty:
+        return
+    settings_dirty = False
+    settings_version += 1
+    executor.submit(write_settings_file, settings_snapshot(), settings_version)
+
+def flush_settings_now():
+    global settings_dirty, settings_save_job, settings_version
+    if settings_save_job is not None:
+        cancel_call(settings_save_job)
+        settings_save_job = None
+    if settings_dirty:
+        settings_dirty = False
+        settings_version += 1
+        write_settings_file(settings_snapshot(), settings_version)
+    playlist_journal.flush(playlist).result()
+
+def open_library_db():
+    conn = sqlite3.connect(LIBRARY_DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+    conn.execute("CREATE TABLE IF NOT EXISTS tags (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                 "title TEXT, artist TEXT, album TEXT, track INTEGER, duration REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS loudness (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                 "loudness REAL, peak REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                 "head TEXT, digest TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS features (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, slot INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY, path TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS play_tracks (id INTEGER PRIMARY KEY, path TEXT UNIQUE)")
+    conn.execute("CREATE TABLE IF NOT EXISTS play_stats (track INTEGER PRIMARY KEY, plays INTEGER, skips INTEGER, last_played REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS play_stats_plays ON play_stats (plays)")
+    conn.execute("CREATE TABLE IF NOT EXISTS play_log (id INTEGER PRIMARY KEY, offset INTEGER)")
+    return conn
+
+# Range bounds that match every path below directory, for an index scan
+def library_path_bounds(directory):
+    return directory + os.sep, directory + chr(ord(os.sep) + 1)
+
+def stat_library_file(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_size, stat.st_mtime)
+
+# The library index only refreshes sizes and mtimes in directories whose own
+# mtime changed, and tag editors rewrite files in place, so passes that cache
+# anything per file version stat every file instead of trusting the index.
+# Takes rows that start with (path, size, mtime) from the files table and
+# yields batches of (row, (path, size, mtime) as the file is now), leaving out
+# files that are gone; what the stat finds is written back to the index.
+# Stops early once cancelled() is true.
+def restat_library_rows(conn, rows, cancelled):
+    for start in range(0, len(rows), LIBRARY_STAT_BATCH):
+        if cancelled():
+            return
+        batch = rows[start:start + LIBRARY_STAT_BATCH]
+        current = list(metadata_executor.map(stat_library_file, [row[0] for row in batch]))
+        changed = [(entry[1], entry[2], entry[0]) for row, entry in zip(batch, current) if entry is not None and entry != row[:3]]
+        if changed:
+            with conn:
+                conn.executemany("UPDATE files SET size = ?, mtime = ? WHERE path = ?", changed)
+        yield [(row, entry) for row, entry in zip(batch, current) if entry is not None]
+
+# Library files under directory with no row in table, or a row made from an
+# older version of the file, as (path, size, mtime), or None once cancelled
+def stale_library_files(conn, table, directory, cancelled):
+    rows = conn.execute(f"SELECT f.path, f.size, f.mtime, x.size, x.mtime FROM files f LEFT JOIN {table} x ON x.path = f.path "
+                        "WHERE f.path >= ? AND f.path < ?", library_path_bounds(directory)).fetchall()
+    stale = []
+    for batch in restat_library_rows(conn, rows, cancelled):
+        stale.extend(entry for row, entry in batch if entry[1:] != row[3:])
+    return None if cancelled() else stale
+
+def scan_library_dir(path, stat_files=True):
+    subdirs = []
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(SUPPORTED_FORMATS):
+                    if stat_files:
+                        stat = entry.stat()
+                        entries.append((entry.path, stat.st_size, stat.st_mtime))
+                    else:
+                        entries.append((entry.path, None, None))
+            except OSError:
+                continue
+    subdirs.sort()
+    entries.sort()
+    return subdirs, entries
+
+# Only directories whose mtime changed since the last scan are listed again,
+# everything else comes straight out of the index
+def visit_library_dir(conn, path):
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if conn is not None:
+        row = conn.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            subdirs = [r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent = ? ORDER BY path", (path,))]
+            files = [r[0] for r in conn.execute("SELECT path FROM files WHERE dir = ? ORDER BY path", (path,))]
+            return subdirs, files, None
+    try:
+        subdirs, entries = scan_library_dir(path, stat_files=conn is not None)
+    except OSError:
+        return None
+    change = (path, mtime, subdirs, entries) if conn is not None else None
+    return subdirs, [entry[0] for entry in entries], change
+
+def iter_library_tree(conn, top):
+    stack = [top]
+    while stack:
+        visited = visit_library_dir(conn, stack.pop())
+        if visited is None:
+            continue
+        subdirs, files, change = visited
+        yield files, change
+        stack.extend(reversed(subdirs))
+
+def walk_library_subtree(position, path, indexed, results, cancelled):
+    conn = open_library_db() if indexed else None
+    try:
+        for files, change in iter_library_tree(conn, path):
+            if cancelled():
+                break
+            results.put((position, files, change))
+    finally:
+        if conn is not None:
+            conn.close()
+        results.put((position, None, None))
+
+# Splits the tree into subtrees a few levels down and walks them concurrently.
+# Batches come out in pre-order with sorted directories, so the order does not
+# depend on which worker finishes first: directories of the subtree being
+# emitted are passed on as soon as they are listed, later subtrees are held
+# back until the ones before them are done. Once cancelled() returns true the
+# walk stops and nothing is saved to the index.
+def stream_music_tree(directory, indexed=False, workers=None, cancelled=None):
+    if not directory:
+        return
+    cancelled = cancelled or (lambda: False)
+    workers = max(1, workers or scan_workers)
+    started = time.perf_counter() if instrumentation_enabled else None
+    conn = open_library_db() if indexed else None
+    try:
+        units = [os.path.abspath(directory)]
+        changes = []
+        for _ in range(SCAN_SPLIT_DEPTH):
+            if sum(isinstance(unit, str) for unit in units) >= workers * 4:
+                break
+            expanded = []
+            for unit in units:
+                if cancelled():
+                    return
+                if not isinstance(unit, str):
+                    expanded.append(unit)
+                    continue
+                visited = visit_library_dir(conn, unit)
+                if visited is None:
+                    continue
+                subdirs, files, change = visited
+                if change is not None:
+                    changes.append(change)
+                expanded.append(files)
+                expanded.extend(subdirs)
+            units = expanded
+
+        # Open the leftmost directories until one has tracks, so the first
+        # batch does not wait behind the pool
+        while units and (isinstance(units[0], str) or not units[0]):
+            if cancelled():
+                return
+            unit = units.pop(0)
+            if not isinstance(unit, str):
+                continue
+            visited = visit_library_dir(conn, unit)
+            if visited is None:
+                continue
+            subdirs, files, change = visited
+            if change is not None:
+                changes.append(change)
+            units[:0] = [files] + subdirs
+        if units:
+            yield units.pop(0)
+
+        results = queue.Queue()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            walks = [pool.submit(walk_library_subtree, position, unit, indexed, results, cancelled)
+                     for position, unit in enumerate(units) if isinstance(unit, str)]
+            buffered = {}
+            finished = set()
+            position = 0
+            while position < len(units):
+                if cancelled():
+                    break
+                unit = units[position]
+                if not isinstance(unit, str):
+                    if unit:
+                        yield unit
+                    position += 1
+                elif buffered.get(position):
+                    yield [path for files in buffered.pop(position) for path in files]
+                elif position in finished:
+                    position += 1
+                else:
+                    walked, files, change = results.get()
+                    if files is None:
+                        finished.add(walked)
+                        continue
+                    if change is not None:
+                        changes.append(change)
+                    if files:
+                        buffered.setdefault(walked, []).append(files)
+            for walk in walks:
+                walk.result()
+        if conn is not None and not cancelled():
+            save_library_changes(conn, changes)
+    finally:
+        if conn is not None:
+            conn.close()
+    if started is not None:
+        record_latency("library_scan", started)
+
+def scan_music_tree(directory, indexed=False, workers=None):
+    songs = []
+    for batch in stream_music_tree(directory, indexed, workers):
+        songs.extend(batch)
+    return songs
+
+def forget_library_dir(conn, path):
+    bounds = (path,) + library_path_bounds(path)
+    conn.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", bounds)
+    conn.execute("DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)", bounds)
+
+def save_library_changes(conn, changes):
+    with conn:
+        for path, mtime, subdirs, entries in changes:
+            known = {r[0] for r in conn.execute("SELECT path FROM dirs WHERE parent = ?", (path,))}
+            for gone in known.difference(subdirs):
+                forget_library_dir(conn, gone)
+            conn.execute("DELETE FROM files WHERE dir = ?", (path,))
+            conn.executemany("INSERT OR REPLACE INTO files (path, dir, size, mtime) VALUES (?, ?, ?, ?)",
+                             [(file, path, size, file_mtime) for file, size, file_mtime in entries])
+            conn.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)",
+                         (path, os.path.dirname(path), mtime))
+
+# Every track is stored once, as a directory id plus its file name, and the
+# library, playlist, history and search index only hold integer ids. Ids are
+# never reused, so an id that outlives its file still maps to its old path.
+# Names are kept encoded, back to back in one bytearray with an offset table,
+# and found through an open-addressing table of ids keyed on directory and
+# name, so a track costs its name's bytes and a few array slots instead of a
+# string, a dict entry and an int object.
+class TrackStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dir_ids = {}
+        self.dirs = []
+        self.dir_tracks = []
+        self.names = bytearray()
+        self.name_offsets = array('I', [0])
+        self.track_dirs = array('I')
+        self.slots = array('I', [TRACK_SLOT_EMPTY]) * TRACK_SLOTS_INITIAL
+        # Each directory mapped to the subdirectories that hold tracks somewhere
+        # below them, so under() only walks the subtree it was asked about
+        self.children = {}
+
+    def intern(self, path):
+        directory, name = os.path.split(path)
+        key = os.fsencode(name)
+        with self.lock:
+            dir_id = self.dir_ids.get(directory)
+            if dir_id is None:
+                dir_id = self.dir_ids[directory] = len(self.dirs)
+                self.dirs.append(directory)
+                self.dir_tracks.append(array('I'))
+                self.link(directory)
+            slot = self.find(dir_id, key)
+            track = self.slots[slot]
+            if track == TRACK_SLOT_EMPTY:
+                track = self.slots[slot] = len(self.track_dirs)
+                self.names += key
+                self.name_offsets.append(len(self.names))
+                self.track_dirs.append(dir_id)
+                self.dir_tracks[dir_id].append(track)
+                # Kept at most half full so probe runs stay short
+                if len(self.track_dirs) * 2 > len(self.slots):
+                    self.grow()
+            return track
+
+    def key(self, track):
+        return bytes(self.names[self.name_offsets[track]:self.name_offsets[track + 1]])
+
+    def path(self, track):
+        return os.path.join(self.dirs[self.track_dirs[track]], os.fsdecode(self.key(track)))
+
+    # The slot holding the track with this directory and encoded name, or the
+    # empty slot where it would go. Callers hold the lock.
+    def find(self, dir_id, key):
+        mask = len(self.slots) - 1
+        slot = hash((dir_id, key)) & mask
+        while True:
+            track = self.slots[slot]
+            if track == TRACK_SLOT_EMPTY or (self.track_dirs[track] == dir_id and self.key(track) == key):
+                return slot
+            slot = (slot + 1) & mask
+
+    def grow(self):
+        self.slots = array('I', [TRACK_SLOT_EMPTY]) * (len(self.slots) * 2)
+        for track in range(len(self.track_dirs)):
+            self.slots[self.find(self.track_dirs[track], self.key(track))] = track
+
+    def link(self, directory):
+        parent = os.path.dirname(directory)
+        while parent != directory:
+            children = self.children.get(parent)
+            if children is not None:
+                children.add(directory)
+                return
+            self.children[parent] = {directory}
+            directory, parent = parent, os.path.dirname(parent)
+
+    def under(self, top):
+        with self.lock:
+            found = set()
+            pending = [top]
+            while pending:
+                directory = pending.pop()
+                dir_id = self.dir_ids.get(directory)
+                if dir_id is not None:
+                    found.update(self.dir_tracks[dir_id])
+                pending.extend(self.children.get(directory, ()))
+            dir_id = self.dir_ids.get(os.path.dirname(top))
+            if dir_id is not None:
+                track = self.slots[self.find(dir_id, os.fsencode(os.path.basename(top)))]
+                if track != TRACK_SLOT_EMPTY:
+                    found.add(track)
+            return found
+
+track_store = TrackStore()
+
+def track_id(path):
+    return track_store.intern(path)
+
+def track_path(track):
+    return track_store.path(track)
+
+# on_batch gets the ids of each batch as it is found. The first batch goes out
+# straight away so playback can start, later ones are coalesced.
+def scan_library(directory, on_batch=None, cancelled=None):
+    songs = array('I')
+    pending = array('I')
+    flushed = None
+    for batch in stream_music_tree(directory, indexed=True, cancelled=cancelled):
+        ids = array('I', map(track_id, batch))
+        songs.extend(ids)
+        if on_batch is None:
+            continue
+        pending.extend(ids)
+        if flushed is None or len(pending) >= SCAN_BATCH_SIZE or time.monotonic() - flushed >= SCAN_BATCH_INTERVAL:
+            on_batch(pending)
+            pending = array('I')
+            flushed = time.monotonic()
+    if on_batch is not None and pending:
+        on_batch(pending)
+    return songs
+
+def list_library_dirs(directory):
+    conn = open_library_db()
+    try:
+        return [r[0] for r in conn.execute("SELECT path FROM dirs WHERE path = ? OR (path >= ? AND path < ?) ORDER BY path",
+                                           (directory,) + library_path_bounds(directory))]
+    finally:
+        conn.close()
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Any object with add_watch/rename_watches/read/close can stand in for this one
+class InotifyBackend:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+
+    def rename_watches(self, src, dst):
+        for wd, path in self.paths.items():
+            self.paths[wd] = rebase_path(path, src, dst)
+
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, cookie, None))
+            elif mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                events.append((mask, cookie, os.path.join(self.paths[wd], name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def create_watch_backend():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return InotifyBackend()
+    except (OSError, AttributeError) as e:
+        log_to_file(f"Error starting inotify: {str(e)}")
+        return None
+
+def rebase_path(path, src, dst):
+    if path == src:
+        return dst
+    if path.startswith(src + os.sep):
+        return dst + path[len(src):]
+    return path
+
+def moved_tracks(src, dst):
+    return {track: track_id(rebase_path(track_path(track), src, dst)) for track in track_store.under(src)}
+
+# Turns raw backend events into ("created" | "deleted" | "moved" | "rescan", path, target)
+# tuples on self.events, which the Tk side drains in process_library_events.
+# After an overflow the Tk side rescans the library, queues the result as a
+# "reset" and sets self.rewatch, so directories created during the gap get
+# watches too.
+class LibraryWatcher(threading.Thread):
+    def __init__(self, directory, backend):
+        super().__init__(daemon=True)
+        self.directory = directory
+        self.backend = backend
+        self.events = queue.Queue()
+        self.stopped = threading.Event()
+        self.rewatch = threading.Event()
+        self.rescanning = False
+        self.watch_failed = False
+
+    def watch(self, path):
+        try:
+            self.backend.add_watch(path)
+        except OSError as e:
+            if not self.watch_failed:
+                self.watch_failed = True
+                log_to_file(f"Error watching directory: {str(e)}")
+
+    def add_tree(self, top):
+        for dirpath, dirs, files in os.walk(top):
+            self.watch(dirpath)
+            for file in sorted(files):
+                if file.endswith(SUPPORTED_FORMATS):
+                    self.events.put(("created", os.path.join(dirpath, file), None))
+
+    def translate(self, raw_events):
+        moved_from = {}
+        for mask, cookie, path in raw_events:
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_Q_OVERFLOW:
+                if not self.rescanning:
+                    self.rescanning = True
+                    self.events.put(("rescan", None, None))
+            elif mask & IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                src, _ = moved_from.pop(cookie)
+                if is_dir:
+                    self.backend.rename_watches(src, path)
+                    self.events.put(("moved", src, path))
+                elif not src.endswith(SUPPORTED_FORMATS):
+                    if path.endswith(SUPPORTED_FORMATS):
+                        self.events.put(("created", path, None))
+                elif path.endswith(SUPPORTED_FORMATS):
+                    self.events.put(("moved", src, path))
+                else:
+                    self.events.put(("deleted", src, None))
+            elif mask & (IN_CREATE | IN_MOVED_TO) and is_dir:
+                self.add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and not is_dir:
+                if path.endswith(SUPPORTED_FORMATS):
+                    self.events.put(("created", path, None))
+            elif mask & IN_DELETE:
+                self.events.put(("deleted", path, None))
+        for src, is_dir in moved_from.values():
+            self.events.put(("deleted", src, None))
+
+    def run(self):
+        try:
+            for path in list_library_dirs(self.directory):
+                self.watch(path)
+            while not self.stopped.is_set():
+                if self.rewatch.is_set():
+                    self.rewatch.clear()
+                    self.rescanning = False
+                    for path in list_library_dirs(self.directory):
+                        self.watch(path)
+                self.translate(self.backend.read(0.5))
+        except Exception as e:
+            log_to_file(f"Error watching library: {str(e)}")
+        finally:
+            self.backend.close()
+
+    def stop(self):
+        self.stopped.set()
+
+def start_library_watcher(directory):
+    global library_watcher
+    stop_library_watcher()
+    backend = create_watch_backend()
+    if backend is None:
+        update_error_label("Library watching is not supported on this system")
+        return
+    library_watcher = LibraryWatcher(os.path.abspath(directory), backend)
+    library_watcher.start()
+    process_library_events()
+
+# Events lost to an overflow are recovered by scanning the library again off
+# the watcher thread, so reading new events carries on meanwhile
+def rescan_watched_library():
+    watcher = library_watcher
+
+    def rescanned(songs):
+        if watcher is library_watcher:
+            watcher.events.put(("reset", songs, None))
+            watcher.rewatch.set()
+
+    run_in_background(lambda: scan_library(watcher.directory, cancelled=lambda: watcher is not library_watcher), rescanned)
+
+def stop_library_watcher():
+    global library_watcher, library_events_job
+    if library_watcher is not None:
+        library_watcher.stop()
+        library_watcher = None
+    if library_events_job:
+        cancel_call(library_events_job)
+        library_events_job = None
+
+# Folds changes (track -> new track, or None once deleted) into remap, so that
+# remap always takes a track from before the drain to where it is now
+def compose_remap(remap, changes):
+    for track, current in remap.items():
+        if current in changes:
+            remap[track] = changes[current]
+    for track, current in changes.items():
+        remap.setdefault(track, current)
+
+def remap_tracks(tracks, remap):
+    return array('I', (current for current in (remap.get(track, track) for track in tracks) if current is not None))
+
+# Deletes and moves from one drain are folded into a single remap, and the
+# library is filtered once at the end. Created tracks are kept apart, since a
+# file created where another was moved from reuses that track's id. The
+# playlist gets a remove or move edit for each event that touches it, so the
+# journal records one line per change rather than a fresh snapshot.
+def apply_library_events(events):
+    global song_files
+    before = song_files
+    rebuilt = False
+    library_remap = {}
+    playlist_edited = False
+    created = []
+    for kind, path, target in events:
+        if kind == "rescan":
+            rescan_watched_library()
+        elif kind == "reset":
+            song_files = path
+            rebuilt = True
+            library_remap = {}
+            created = []
+        elif kind == "created":
+            created.append(track_id(path))
+        elif kind in ("deleted", "moved"):
+            if kind == "deleted":
+                changes = dict.fromkeys(track_store.under(path))
+                playlist_edited = edit_playlist("remove", path) or playlist_edited
+            else:
+                changes = moved_tracks(path, target)
+                playlist_edited = edit_playlist("move", path, target) or playlist_edited
+            compose_remap(library_remap, changes)
+            created = remap_tracks(created, changes)
+    if library_remap or created:
+        remaining = array('I')
+        seen = set()
+        for track in itertools.chain(remap_tracks(song_files, library_remap), created):
+            if track not in seen:
+                seen.add(track)
+                remaining.append(track)
+        song_files = remaining
+    # Appends alone leave every index in place, and the bag grows on its own
+    if rebuilt or library_remap:
+        library_shuffle.rebuild(before, song_files, library_remap)
+    sync_search_index("library", song_files)
+    if playlist_edited:
+        playlist_changed()
+
+def process_library_events():
+    global library_events_job
+    if library_watcher is None:
+        return
+    events = []
+    try:
+        while True:
+            events.append(library_watcher.events.get_nowait())
+    except queue.Empty:
+        pass
+    if events:
+        try:
+            apply_library_events(events)
+        except Exception as e:
+            update_error_label(f"Error applying library changes: {str(e)}")
+            log_to_file(f"Error applying library changes: {str(e)}")
+    library_events_job = schedule_call(500, process_library_events)
+
+def first_tag(tags, key):
+    if not tags:
+        return ""
+    values = tags.get(key) or tags.get(key.title())
+    return str(values[0]) if values else ""
+
+def read_track_tags(entry):
+    path, size, mtime = entry
+    title = artist = album = ""
+    track = duration = None
+    try:
+        import mutagen
+        audio = mutagen.File(path, easy=True)
+        if audio is not None:
+            title = first_tag(audio.tags, "title")
+            artist = first_tag(audio.tags, "artist")
+            album = first_tag(audio.tags, "album")
+            number = first_tag(audio.tags, "tracknumber").split("/")[0]
+            track = int(number) if number.isdigit() else None
+            duration = getattr(audio.info, "length", None)
+    except Exception as e:
+        log_to_file(f"Error extracting metadata from {path}: {str(e)}")
+    return (path, size, mtime, title, artist, album, track, duration)
+
+def store_track_tags(conn, rows):
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO tags (path, size, mtime, title, artist, album, track, duration) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    with metadata_cache_lock:
+        for row in rows:
+            metadata_cache.pop(row[0], None)
+
+def refresh_metadata_cache(directory, generation):
+    try:
+        conn = open_library_db()
+        try:
+            stale = stale_library_files(conn, "tags", directory, lambda: generation != metadata_generation)
+            if stale is None:
+                return
+            for start in range(0, len(stale), METADATA_BATCH):
+                if generation != metadata_generation:
+                    return
+                store_track_tags(conn, list(metadata_executor.map(read_track_tags, stale[start:start + METADATA_BATCH])))
+        finally:
+            conn.close()
+    except Exception as e:
+        log_to_file(f"Error refreshing metadata cache: {str(e)}")
+
+def start_metadata_refresh(directory):
+    global metadata_generation
+    metadata_generation += 1
+    library_pass_executor.submit(refresh_metadata_cache, os.path.abspath(directory), metadata_generation)
+
+def cache_track_metadata(path):
+    try:
+        stat = os.stat(path)
+        conn = open_library_db()
+        try:
+            row = conn.execute("SELECT size, mtime FROM tags WHERE path = ?", (path,)).fetchone()
+            if row != (stat.st_size, stat.st_mtime):
+                store_track_tags(conn, [read_track_tags((path, stat.st_size, stat.st_mtime))])
+        finally:
+            conn.close()
+        return True
+    except (OSError, sqlite3.Error) as e:
+        log_to_file(f"Error caching metadata: {str(e)}")
+        return False
+
+def metadata_ready(path, cached):
+    metadata_pending.discard(path)
+    if not cached:
+        metadata_failed.add(path)
+    elif path == current_song:
+        update_playing_label(path)
+
+# Never touches the audio file; a miss is filled in by a background worker
+def get_track_metadata(path):
+    global metadata_conn
+    with metadata_cache_lock:
+        tags = metadata_cache.get(path)
+    if tags is not None:
+        return tags
+    if metadata_conn is None:
+        metadata_conn = open_library_db()
+    row = metadata_conn.execute("SELECT title, artist, album, track, duration FROM tags WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        if path not in metadata_pending and path not in metadata_failed:
+            metadata_pending.add(path)
+            run_in_background(lambda: cache_track_metadata(path), lambda cached: metadata_ready(path, cached), pool=metadata_executor)
+        return None
+    tags = {"title": row[0], "artist": row[1], "album": row[2], "track": row[3], "duration": row[4]}
+    with metadata_cache_lock:
+        if len(metadata_cache) >= METADATA_CACHE_SIZE:
+            metadata_cache.pop(next(iter(metadata_cache)))
+        metadata_cache[path] = tags
+    return tags
+
+# Weights that turn the power spectrum of a 100 ms segment into the mean square
+# of its K-weighted samples, folding in the filter response and Parseval's
+# theorem for a real FFT
+def k_weighting_weights():
+    import numpy as np
+    z = np.exp(-1j * np.pi * np.arange(LOUDNESS_SEGMENT // 2 + 1) / (LOUDNESS_SEGMENT // 2))
+    response = np.ones(len(z))
+    for b, a in K_WEIGHTING_FILTERS:
+        response *= np.abs((b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)) ** 2
+    fold = np.full(len(z), 2.0)
+    fold[0] = fold[-1] = 1.0
+    return response * fold / LOUDNESS_SEGMENT ** 2
+
+# 400 ms blocks overlapping by 75%, with the absolute and relative gates of
+# EBU R128
+def integrated_loudness(energies):
+    import numpy as np
+    if len(energies) >= 4:
+        blocks = np.convolve(energies, np.full(4, 0.25), mode="valid")
+    else:
+        blocks = np.array([energies.mean()])
+    gated = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]
+    if not len(gated):
+        return None
+    gated = gated[gated > gated.mean() * 0.1]
+    return round(float(-0.691 + 10 * np.log10(gated.mean())), 2)
+
+# Runs in a worker process: ffmpeg decodes to 48 kHz stereo floats, which are
+# read and reduced a few seconds at a time so memory does not grow with length
+def analyze_track_loudness(entry):
+    path, size, mtime = entry
+    loudness = peak = None
+    try:
+        import numpy as np
+        weights = k_weighting_weights()
+        process = subprocess.Popen(["ffmpeg", "-v", "error", "-nostdin", "-i", path, "-map", "0:a:0", "-f", "f32le",
+                                    "-ac", "2", "-ar", str(LOUDNESS_RATE), "-"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        energies = []
+        peak = 0.0
+        segment_bytes = LOUDNESS_SEGMENT * 2 * 4
+        with process.stdout:
+            while True:
+                data = process.stdout.read(segment_bytes * LOUDNESS_READ_SEGMENTS)
+                segments = len(data) // segment_bytes
+                if not segments:
+                    break
+                samples = np.frombuffer(data, dtype=np.float32, count=segments * LOUDNESS_SEGMENT * 2)
+                samples = samples.reshape(segments, LOUDNESS_SEGMENT, 2)
+                peak = max(peak, float(np.abs(samples).max()))
+                spectrum = np.fft.rfft(samples, axis=1)
+                energies.append((spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=2) @ weights)
+        if process.wait() == 0 and energies:
+            loudness = integrated_loudness(np.concatenate(energies))
+        else:
+            peak = None
+    except Exception as e:
+        peak = None
+        log_to_file(f"Error analyzing loudness of {path}: {str(e)}")
+    return (path, size, mtime, loudness, peak)
+
+def analysis_available():
+    return importlib.util.find_spec("numpy") is not None and shutil.which("ffmpeg") is not None
+
+def get_analysis_executor():
+    global analysis_executor
+    if analysis_executor is None:
+        # Forking a process that already runs Tk, SDL audio and several thread
+        # pools can deadlock the child, so workers start from a fresh interpreter
+        analysis_executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=lower_process_priority)
+    return analysis_executor
+
+def store_track_loudness(conn, rows):
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO loudness (path, size, mtime, loudness, peak) VALUES (?, ?, ?, ?, ?)", rows)
+
+# Same shape as the metadata refresh, but decoding is CPU bound, so the work
+# goes to a process pool. Batches are one track per worker so closing the
+# player never waits long for a batch to drain.
+def refresh_loudness_cache(directory, generation):
+    try:
+        conn = open_library_db()
+        try:
+            stale = stale_library_files(conn, "loudness", directory, lambda: generation != loudness_generation)
+            if stale is None:
+                return
+            for start in range(0, len(stale), ANALYSIS_WORKERS):
+                if generation != loudness_generation:
+                    return
+                store_track_loudness(conn, list(get_analysis_executor().map(analyze_track_loudness, stale[start:start + ANALYSIS_WORKERS])))
+        finally:
+            conn.close()
+    except Exception as e:
+        log_to_file(f"Error refreshing loudness cache: {str(e)}")
+
+def start_loudness_refresh(directory):
+    global loudness_generation
+    loudness_generation += 1
+    if normalize_enabled and directory and analysis_available():
+        library_pass_executor.submit(refresh_loudness_cache, os.path.abspath(directory), loudness_generation)
+
+def get_track_gain(path):
+    global metadata_conn
+    if not normalize_enabled or not path:
+        return 1.0
+    if metadata_conn is None:
+        metadata_conn = open_library_db()
+    row = metadata_conn.execute("SELECT loudness, peak FROM loudness WHERE path = ?", (path,)).fetchone()
+    if row is None or row[0] is None:
+        return 1.0
+    loudness, peak = row
+    gain = 10 ** ((LOUDNESS_TARGET_LUFS - loudness) / 20)
+    if peak:
+        gain = min(gain, 1 / peak)
+    return gain
+
+def apply_track_gain(path):
+    global track_gain
+    track_gain = get_track_gain(path)
+    pygame.mixer.music.set_volume(volume_level / 100 * track_gain)
+
+# Per frame: spectral centroid, rolloff and flatness, RMS energy, zero
+# crossing rate and spectral flux
+def frame_features(samples):
+    import numpy as np
+    magnitude = np.abs(np.fft.rfft(samples * np.hanning(FEATURE_FRAME), axis=1))
+    top = magnitude.shape[1] - 1
+    total = magnitude.sum(axis=1) + 1e-10
+    centroid = (magnitude * np.arange(top + 1)).sum(axis=1) / total / top
+    rolloff = (np.cumsum(magnitude, axis=1) < 0.85 * total[:, None]).sum(axis=1) / top
+    flatness = np.exp(np.log(magnitude + 1e-10).mean(axis=1)) / (magnitude.mean(axis=1) + 1e-10)
+    rms = np.sqrt((samples ** 2).mean(axis=1))
+    crossings = (np.diff(np.signbit(samples), axis=1) != 0).mean(axis=1)
+    flux = np.concatenate(([0.0], np.maximum(np.diff(magnitude, axis=0), 0).sum(axis=1)))
+    return np.stack([centroid, rolloff, flatness, rms, crossings, flux], axis=1)
+
+# The strongest autocorrelation peak of the flux between 60 and 200 BPM. A
+# beat also repeats at twice its period, so peaks are weighted towards
+# 120 BPM to settle ties between a tempo and its half.
+def estimate_tempo(flux):
+    import numpy as np
+    fps = FEATURE_RATE / FEATURE_FRAME
+    if len(flux) < fps * 4:
+        return 0.0
+    onset = flux - flux.mean()
+    spectrum = np.fft.rfft(onset, 2 * len(onset))
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:len(onset)]
+    lags = np.arange(int(np.ceil(fps * 60 / 200)), int(fps * 60 / 60) + 1)
+    tempos = 60 * fps / lags
+    # Beats rarely land on a whole number of frames, so each lag takes in its
+    # neighbours
+    peaks = autocorrelation[lags - 1] + autocorrelation[lags] + autocorrelation[lags + 1]
+    weighted = peaks * np.exp(-0.5 * np.log2(tempos / 120) ** 2)
+    return float(tempos[np.argmax(weighted)])
+
+def summarize_features(frames):
+    import numpy as np
+    active = frames[frames[:, 3] > 1e-4]
+    if not len(active):
+        return None
+    energy = 20 * np.log10(active[:, 3])
+    return [float(active[:, 0].mean()), float(active[:, 0].std()), float(active[:, 1].mean()), float(active[:, 2].mean()),
+            float(energy.mean()), float(energy.std()), float(active[:, 4].mean()), estimate_tempo(frames[:, 5])]
+
+# Runs in a worker process, like the loudness analysis
+def analyze_track_features(entry):
+    path, size, mtime = entry
+    features = None
+    try:
+        import numpy as np
+        process = subprocess.Popen(["ffmpeg", "-v", "error", "-nostdin", "-i", path, "-map", "0:a:0", "-t", str(FEATURE_SECONDS),
+                                    "-f", "f32le", "-ac", "1", "-ar", str(FEATURE_RATE), "-"],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        columns = []
+        frame_bytes = FEATURE_FRAME * 4
+        with process.stdout:
+            while True:
+                data = process.stdout.read(frame_bytes * 256)
+                frames = len(data) // frame_bytes
+                if not frames:
+                    break
+                samples = np.frombuffer(data, dtype=np.float32, count=frames * FEATURE_FRAME).reshape(frames, FEATURE_FRAME)
+                columns.append(frame_features(samples))
+        if process.wait() == 0 and columns:
+            features = summarize_features(np.concatenate(columns))
+    except Exception as e:
+        log_to_file(f"Error analyzing features of {path}: {str(e)}")
+    return (path, size, mtime, features)
+
+# Vectors live in one flat file of float32 rows; the features table maps each
+# path to its row. A changed track keeps its row, a new one gets the next.
+# The write lock is taken before the highest row is read, so two passes that
+# overlap cannot hand out the same rows.
+def store_track_features(conn, rows):
+    with open(FEATURES_FILE, "r+b" if os.path.exists(FEATURES_FILE) else "w+b") as f, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        next_slot = conn.execute("SELECT COALESCE(MAX(slot), -1) + 1 FROM features").fetchone()[0]
+        for path, size, mtime, features in rows:
+            slot = None
+            if features is not None:
+                row = conn.execute("SELECT slot FROM features WHERE path = ?", (path,)).fetchone()
+                slot = row[0] if row is not None else None
+                if slot is None:
+                    slot = next_slot
+                    next_slot += 1
+                f.seek(slot * FEATURE_DIMS * 4)
+                f.write(struct.pack(f"{FEATURE_DIMS}f", *features))
+            conn.execute("INSERT OR REPLACE INTO features (path, size, mtime, slot) VALUES (?, ?, ?, ?)",
+                         (path, size, mtime, slot))
+
+class FeatureIndex:
+    def __init__(self, tracks, matrix):
+        self.tracks = tracks
+        self.rows = {track: row for row, track in enumerate(tracks)}
+        self.matrix = matrix
+        self.norms = (matrix * matrix).sum(axis=1)
+
+    # Squared distances come from one matrix-vector product per block, and
+    # only the closest few of each block are kept, so a query over half a
+    # million tracks needs no more than a block's worth of temporaries
+    def nearest(self, track, count, exclude):
+        import numpy as np
+        row = self.rows.get(track)
+        if row is None:
+            return []
+        target = self.matrix[row]
+        keep = count + len(exclude) + 1
+        candidates = []
+        distances = []
+        for start in range(0, len(self.matrix), FEATURE_QUERY_BLOCK):
+            block = slice(start, start + FEATURE_QUERY_BLOCK)
+            block_distances = self.norms[block] - 2 * (self.matrix[block] @ target)
+            picks = np.argpartition(block_distances, min(keep, len(block_distances)) - 1)[:keep]
+            candidates.append(picks + start)
+            distances.append(block_distances[picks])
+        candidates = np.concatenate(candidates)[np.argsort(np.concatenate(distances))]
+        nearest = []
+        for candidate in candidates:
+            neighbour = self.tracks[candidate]
+            if neighbour != track and neighbour not in exclude and neighbour not in duplicate_tracks:
+                nearest.append(neighbour)
+                if len(nearest) == count:
+                    break
+        return nearest
+
+# Features are standardized over the library so no single one dominates the
+# distance
+def load_feature_index(directory):
+    import numpy as np
+    if not os.path.exists(FEATURES_FILE):
+        return None
+    conn = open_library_db()
+    try:
+        rows = conn.execute("SELECT f.path, x.slot FROM files f JOIN features x ON x.path = f.path "
+                            "AND x.size = f.size AND x.mtime = f.mtime "
+                            "WHERE f.path >= ? AND f.path < ? AND x.slot IS NOT NULL ORDER BY x.slot",
+                            library_path_bounds(directory)).fetchall()
+    finally:
+        conn.close()
+    vectors = np.memmap(FEATURES_FILE, dtype=np.float32, mode="r")
+    vectors = vectors[:len(vectors) // FEATURE_DIMS * FEATURE_DIMS].reshape(-1, FEATURE_DIMS)
+    rows = [(path, slot) for path, slot in rows if slot < len(vectors)]
+    if not rows:
+        return None
+    matrix = np.array(vectors[[slot for _, slot in rows]], dtype=np.float32)
+    spread = matrix.std(axis=0)
+    spread[spread == 0] = 1
+    matrix = (matrix - matrix.mean(axis=0)) / spread
+    return FeatureIndex(array('I', (track_id(path) for path, _ in rows)), matrix)
+
+def publish_feature_index(directory, generation):
+    index = load_feature_index(directory)
+    if index is not None:
+        event_loop.call_soon_threadsafe(feature_index_ready, index, generation)
+
+# Whatever is already analyzed is usable straight away; the rest is analyzed
+# in the process pool and published every so often as it comes in
+def refresh_feature_index(directory, generation):
+    try:
+        publish_feature_index(directory, generation)
+        conn = open_library_db()
+        try:
+            stale = stale_library_files(conn, "features", directory, lambda: generation != feature_generation)
+            if stale is None:
+                return
+            analyzed = 0
+            for start in range(0, len(stale), ANALYSIS_WORKERS):
+                if generation != feature_generation:
+                    return
+                batch = stale[start:start + ANALYSIS_WORKERS]
+                store_track_features(conn, list(get_analysis_executor().map(analyze_track_features, batch)))
+                analyzed += len(batch)
+                if analyzed >= FEATURE_PUBLISH_EVERY:
+                    publish_feature_index(directory, generation)
+                    analyzed = 0
+        finally:
+            conn.close()
+        if analyzed:
+            publish_feature_index(directory, generation)
+    except Exception as e:
+        log_to_file(f"Error refreshing smart shuffle features: {str(e)}")
+
+def start_feature_refresh(directory):
+    global feature_generation, feature_index
+    feature_generation += 1
+    feature_index = None
+    if smart_shuffle_enabled and directory and analysis_available():
+        library_pass_executor.submit(refresh_feature_index, os.path.abspath(directory), feature_generation)
+
+def feature_index_ready(index, generation):
+    global feature_index
+    if generation != feature_generation:
+        return
+    feature_index = index
+    update_status_label(f"Smart Shuffle: {len(index.tracks)} songs analyzed")
+
+def smart_next_track():
+    if feature_index is None or current_song is None:
+        return None
+    neighbours = feature_index.nearest(track_id(current_song), SMART_NEIGHBOURS, playback_history.last(SMART_HISTORY))
+    return library_shuffle.rng.choice(neighbours) if neighbours else None
+
+def hash_track_file(path, limit=None):
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if limit is None else min(size, limit)
+            digest = hashlib.blake2b(digest_size=16)
+            if end:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    for start in range(0, end, HASH_CHUNK):
+                        digest.update(view[start:min(end, start + HASH_CHUNK)])
+            return digest.hexdigest()
+    except (OSError, ValueError) as e:
+        log_to_file(f"Error hashing {path}: {str(e)}")
+        return None
+
+def group_entries(entries, key):
+    groups = {}
+    for entry in entries:
+        value = key(entry)
+        if value is not None:
+            groups.setdefault(value, []).append(entry)
+    return [group for group in groups.values() if len(group) > 1]
+
+def hash_entries(entries, limit, cancelled):
+    hashes = []
+    for start in range(0, len(entries), HASH_BATCH):
+        if cancelled():
+            return None
+        hashes.extend(hash_executor.map(lambda entry: hash_track_file(entry[0], limit), entries[start:start + HASH_BATCH]))
+    return hashes
+
+# Only files that share a size can be copies. Those get the first 64 KiB
+# hashed, and only files whose heads also match are hashed in full. Hashes are
+# kept per path, size and mtime, so a file is only read again once it changes;
+# entries must carry the size and mtime from a fresh stat for that to hold.
+# Returns each copy mapped to the first entry with the same content, or None
+# once cancelled() says the result is no longer wanted.
+def find_duplicate_tracks(conn, entries, cancelled):
+    candidates = [entry for group in group_entries(entries, lambda entry: entry[1] or None) for entry in group]
+    cached = {}
+    for start in range(0, len(candidates), 500):
+        paths = [entry[0] for entry in candidates[start:start + 500]]
+        for path, size, mtime, head, digest in conn.execute(
+                f"SELECT path, size, mtime, head, digest FROM hashes WHERE path IN ({','.join('?' * len(paths))})", paths):
+            cached[path] = (size, mtime, head, digest)
+    heads = {}
+    digests = {}
+    for path, size, mtime in candidates:
+        row = cached.get(path)
+        if row is not None and row[:2] == (size, mtime):
+            heads[path], digests[path] = row[2], row[3]
+    missing = [entry for entry in candidates if heads.get(entry[0]) is None]
+    hashes = hash_entries(missing, HASH_HEAD_BYTES, cancelled)
+    if hashes is None:
+        return None
+    for entry, head in zip(missing, hashes):
+        heads[entry[0]] = head
+        digests[entry[0]] = head if head is not None and entry[1] <= HASH_HEAD_BYTES else None
+    matched = [entry for group in group_entries(candidates, lambda entry: heads[entry[0]] and (entry[1], heads[entry[0]]))
+               for entry in group]
+    missing = [entry for entry in matched if digests.get(entry[0]) is None]
+    hashes = hash_entries(missing, None, cancelled)
+    if hashes is None:
+        return None
+    for entry, digest in zip(missing, hashes):
+        digests[entry[0]] = digest
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO hashes (path, size, mtime, head, digest) VALUES (?, ?, ?, ?, ?)",
+                         [(path, size, mtime, heads[path], digests.get(path)) for path, size, mtime in candidates
+                          if cached.get(path) != (size, mtime, heads[path], digests.get(path))])
+    duplicates = {}
+    for group in group_entries(matched, lambda entry: digests[entry[0]] and (entry[1], digests[entry[0]])):
+        for entry in group[1:]:
+            duplicates[entry[0]] = group[0][0]
+    return duplicates
+
+def detect_library_duplicates(directory, generation):
+    try:
+        conn = open_library_db()
+        try:
+            cancelled = lambda: generation != duplicate_generation
+            rows = conn.execute("SELECT path, size, mtime FROM files WHERE path >= ? AND path < ? ORDER BY path",
+                                library_path_bounds(directory)).fetchall()
+            entries = [entry for batch in restat_library_rows(conn, rows, cancelled) for _, entry in batch]
+            if cancelled():
+                return None
+            return find_duplicate_tracks(conn, entries, cancelled)
+        finally:
+            conn.close()
+    except Exception as e:
+        log_to_file(f"Error looking for duplicate songs: {str(e)}")
+        return None
+
+def start_duplicate_scan(directory):
+    global duplicate_generation, duplicate_tracks
+    duplicate_generation += 1
+    duplicate_tracks = set()
+    if not skip_duplicates_enabled or not directory:
+        return
+    generation = duplicate_generation
+    run_in_background(lambda: detect_library_duplicates(os.path.abspath(directory), generation),
+                      lambda duplicates: duplicates_found(duplicates, generation), pool=library_pass_executor)
+
+def duplicates_found(duplicates, generation):
+    global duplicate_tracks
+    if generation != duplicate_generation or duplicates is None:
+        return
+    duplicate_tracks = {track_id(path) for path in duplicates}
+    if duplicate_tracks:
+        update_status_label(f"Skipping {len(duplicate_tracks)} duplicate songs")
+    invalidate_next_song()
+
+# Dropped songs that repeat each other or something already in the playlist
+# are left out. Songs already in the playlist are matched by id; other
+# playlist tracks are only stat'ed and hashed when the index gives them the
+# size of a dropped song.
+def drop_duplicate_songs(paths, tracks):
+    present = dict.fromkeys(tracks)
+    paths = [path for path in paths if track_id(path) not in present]
+    dropped = [entry for entry in map(stat_library_file, paths) if entry is not None]
+    sizes = {entry[1] for entry in dropped}
+    conn = open_library_db()
+    try:
+        playlist_paths = [track_path(track) for track in present]
+        indexed = {}
+        for start in range(0, len(playlist_paths), 500):
+            chunk = playlist_paths[start:start + 500]
+            indexed.update(conn.execute(f"SELECT path, size FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        candidates = [path for path in playlist_paths if path not in indexed or indexed[path] in sizes]
+        entries = [entry for entry in map(stat_library_file, candidates) if entry is not None and entry[1] in sizes]
+        duplicates = find_duplicate_tracks(conn, entries + dropped, lambda: closing)
+    finally:
+        conn.close()
+    if duplicates is None:
+        return []
+    return [path for path in paths if path not in duplicates]
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
 
 async def auto_load_dir():
     global current_dir, song_files, song_count, skip_count, start_time
-    current_dir = '/mnt/HDD/Music'  # Linux directory adjustment
+    current_dir = args.music_dir or '/mnt/HDD/Music'  # Linux directory adjustment
     await load_songs_from_directory(current_dir)
 
 async def load_songs_from_directory(directory):
-    global song_files, song_count, skip_count, start_time
+    global song_files, song_count, skip_count, start_time, library_generation, library_loading
+
+    library_generation += 1
+    generation = library_generation
+    library_loading = True
+    stop_library_watcher()
+    song_files = array('I')
+    library_shuffle.reset()
+    # The prefetched pick and the queued track belong to the old directory
+    invalidate_next_song()
+
+    def add_batch(ids):
+        global song_count, skip_count, start_time, idle_skip_task
+        if generation != library_generation:
+            return
+        first = not song_files
+        # The shuffle bag grows to cover the new tracks on its next draw
+        song_files.extend(ids)
+        update_status_label(f"Scanning: {len(song_files)} songs found")
+        state_changed()
+        if first:
+            song_count = 0
+            skip_count = 0
+            start_time = datetime.datetime.now()
+            idle_skip_task = run_async(skip_song(), "Error starting playback")
 
-    song_files = []
-    loop = asyncio.get_event_loop()
-    song_files = await loop.run_in_executor(executor, lambda: [
-        os.path.abspath(os.path.join(root, file))
-        for root, dirs, files in os.walk(directory)
-        for file in sorted(files)
-        if file.endswith(SUPPORTED_FORMATS)
-    ])
+    try:
+        songs = await event_loop.run_in_executor(
+            executor, scan_library, directory,
+            lambda ids: event_loop.call_soon_threadsafe(add_batch, ids),
+            lambda: generation != library_generation)
+    finally:
+        if generation == library_generation:
+            library_loading = False
+    if generation != library_generation:
+        return
+    mark_startup("library")
+    # Every batch was delivered before the scan returned, so this is the same
+    # list in the same order
+    song_files = songs
+    sync_search_index("library", song_files)
+    state_changed()
+    start_metadata_refresh(directory)
+    start_loudness_refresh(directory)
+    start_duplicate_scan(directory)
+    start_feature_refresh(directory)
+    if watch_library_enabled:
+        start_library_watcher(directory)
 
     if not song_files:
         update_status_label("No songs found in the selected directory")
+        mark_startup("first_song", final=True)
         return
+    update_status_label(f"Library loaded: {len(song_files)} songs")
+    # The next track was picked while only the first batch was known
+    invalidate_next_song()
+
+def song_started(song_path, record=True):
+    global current_song, song_count
+    current_song = song_path
+    metadata_failed.clear()
+    if record:
+        playback_history.record(song_path)
+    play_stats.record(song_path, PLAY_STARTED)
+    song_count += 1
+    update_playing_label(song_path)
+    update_info_label()
+    save_settings()
+    state_changed()
+    update_status_label(f"Playing: {os.path.basename(song_path)}")
+    mark_startup("first_song", final=True)
 
-    song_count = 0
-    skip_count = 0
-    start_time = datetime.datetime.now()
-    await skip_song()
-
-async def play_song(song_path):
-    global current_song, song_count, prev_songs
+async def play_song(song_path, skip_started=None, record=True):
+    global queued_song
     try:
         pygame.mixer.music.load(song_path)
+        apply_track_gain(song_path)
         pygame.mixer.music.play()
-        current_song = song_path
-        prev_songs.append(song_path)
-        song_count += 1
-        update_playing_label(song_path)
-        save_settings()
-        update_status_label(f"Playing: {os.path.basename(song_path)}")
+        if skip_started is not None:
+            record_latency("skip_to_audio", skip_started)
+        queued_song = None
+        song_started(song_path, record)
+        prepare_next_song()
     except pygame.error as e:
         update_error_label(f"Error playing song: {str(e)}")
         log_to_file(f"Error playing song: {str(e)}")
@@ -163,7 +1865,9 @@ def pause_music():
     try:
         pygame.mixer.music.pause()
         music_paused = True
-        pause_button.config(text="Pause: On", fg="green")
+        state_changed()
+        if root is not None:
+            pause_button.config(text="Pause: On", fg="green")
         update_status_label("Music Paused")
         update_error_label("Music is paused, cannot skip")
     except Exception as e:
@@ -176,7 +1880,9 @@ def unpause_music():
         if current_song is not None:
             pygame.mixer.music.unpause()
             music_paused = False
-            pause_button.config(text="Pause: Off", fg="red")
+            state_changed()
+            if root is not None:
+                pause_button.config(text="Pause: Off", fg="red")
             update_status_label("Music Resumed")
     except Exception as e:
         update_error_label(f"Error unpausing music: {str(e)}")
@@ -186,8 +1892,10 @@ def set_volume(level):
     global volume_level
     try:
         volume_level = int(level)
-        pygame.mixer.music.set_volume(volume_level / 100)
-        volume_label.config(text=f"Volume: {volume_level}%")
+        pygame.mixer.music.set_volume(volume_level / 100 * track_gain)
+        state_changed()
+        if root is not None:
+            volume_label.config(text=f"Volume: {volume_level}%")
         save_settings()
     except Exception as e:
         update_error_label(f"Error setting volume: {str(e)}")
@@ -201,8 +1909,136 @@ def decrease_volume():
     if volume_level > 0:
         set_volume(volume_level - 5)
 
+# Fisher-Yates over indices 0..size-1, permuted lazily: only positions that
+# have been swapped are stored, so draws and new cycles are O(1). Indices added
+# mid-cycle are swapped into the undrawn part; indices past a shrunk size are
+# parked when they come up and put back if the source grows again. A source
+# that is reordered or loses entries goes through rebuild(), which carries the
+# cycle over by track rather than by index.
+class ShuffleBag:
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.epoch = 0
+        self.reset()
+
+    def reset(self):
+        self.swaps = {}
+        self.parked = []
+        self.size = 0
+        self.capacity = 0
+        self.remaining = 0
+        self.last = None
+        self.epoch += 1
+
+    def add(self, index):
+        self.swaps[self.remaining] = index
+        self.remaining += 1
+
+    def resize(self, size):
+        if size > self.size and self.parked:
+            parked = self.parked
+            self.parked = [index for index in parked if index >= size]
+            for index in parked:
+                if index < size:
+                    self.add(index)
+        if self.remaining == self.capacity and size > self.capacity:
+            self.capacity = self.remaining = size
+        while self.capacity < size:
+            if self.capacity != self.remaining:
+                self.add(self.capacity)
+            else:
+                self.remaining += 1
+            self.capacity += 1
+        self.size = size
+
+    def draw(self, size):
+        if size <= 0:
+            raise IndexError("Cannot choose from an empty sequence")
+        self.resize(size)
+        while True:
+            if self.remaining == 0:
+                self.swaps.clear()
+                self.parked.clear()
+                self.capacity = self.remaining = self.size
+                self.epoch += 1
+            pick = self.rng.randrange(self.remaining)
+            self.remaining -= 1
+            index = self.swaps.get(pick, pick)
+            last = self.swaps.pop(self.remaining, self.remaining)
+            if pick != self.remaining:
+                self.swaps[pick] = last
+            if index < self.size:
+                self.last = (index, self.epoch)
+                return index
+            self.parked.append(index)
+
+    # Returns a draw that was never played, unless the cycle or the source has
+    # moved on since
+    def put_back(self, index, epoch):
+        if epoch == self.epoch:
+            self.add(index)
+
+    # old and new are the source before and after an edit; remap takes a track
+    # to its new id, or to None once it is gone. Tracks drawn this cycle stay
+    # drawn wherever they end up and new tracks join the undrawn part.
+    def rebuild(self, old, new, remap=None):
+        undrawn = bytearray(len(old))
+        for position in range(self.remaining):
+            index = self.swaps.get(position, position)
+            if index < len(old):
+                undrawn[index] = 1
+        for index in self.parked:
+            if index < len(old):
+                undrawn[index] = 1
+        undrawn[self.capacity:] = b"\x01" * max(0, len(old) - self.capacity)
+        drawn = {old[index] for index in range(len(old)) if not undrawn[index]}
+        if remap:
+            drawn = {remap.get(track, track) for track in drawn}
+        self.reset()
+        undrawn = bytearray(track not in drawn for track in new)
+        count = sum(undrawn)
+        # Undrawn indices below count stay in place, the rest fill the holes
+        holes = (position for position in range(count) if not undrawn[position])
+        outside = (index for index in range(count, len(new)) if undrawn[index])
+        self.swaps = dict(zip(holes, outside))
+        self.size = self.capacity = len(new)
+        self.remaining = count
+
+library_shuffle = ShuffleBag()
+playlist_shuffle = ShuffleBag()
+
+def set_shuffle_seed(seed):
+    global library_shuffle, playlist_shuffle
+    library_shuffle = ShuffleBag(None if seed is None else f"{seed}-library")
+    playlist_shuffle = ShuffleBag(None if seed is None else f"{seed}-playlist")
+
+# Copies of a song are drawn and passed over, so every recording comes up once
+# per pass through the bag
+def draw_library_track():
+    track = song_files[library_shuffle.draw(len(song_files))]
+    for _ in range(len(duplicate_tracks)):
+        if track not in duplicate_tracks:
+            break
+        track = song_files[library_shuffle.draw(len(song_files))]
+    return track
+
+def choose_next_song():
+    if playlist_only_mode and playlist:
+        track = playlist[skip_count % len(playlist)] if playlist_only_not_random_mode else playlist[playlist_shuffle.draw(len(playlist))]
+    elif song_files:
+        track = None
+        if dir_select_not_random_mode:
+            track = song_files[skip_count % len(song_files)]
+        elif smart_shuffle_enabled:
+            track = smart_next_track()
+        if track is None:
+            track = draw_library_track()
+    else:
+        track = playlist[playlist_shuffle.draw(len(playlist))] if repeat_enabled else song_files[library_shuffle.draw(len(song_files))]
+    return track_path(track)
+
 async def skip_song():
-    global song_files, skip_count, prev_songs, playlist, repeat_enabled, playlist_only_mode, playlist_only_not_random_mode, dir_select_not_random_mode
+    global song_files, skip_count, playlist, repeat_enabled, playlist_only_mode, playlist_only_not_random_mode, dir_select_not_random_mode
 
     try:
         if not song_files and not (repeat_enabled and playlist):
@@ -210,41 +2046,106 @@ async def skip_song():
             return
 
         if not music_paused:
-            if playlist_only_mode and playlist:
-                song_file = playlist[skip_count % len(playlist)] if playlist_only_not_random_mode else random.choice(playlist)
-            elif song_files:
-                song_file = song_files[skip_count % len(song_files)] if dir_select_not_random_mode else random.choice(song_files)
-            else:
-                song_file = random.choice(playlist) if repeat_enabled else random.choice(song_files)
-            await play_song(song_file)
+            started = time.perf_counter() if instrumentation_enabled else None
+            song_file = next_song or choose_next_song()
             skip_count += 1
+            await play_song(song_file, started)
         else:
             update_error_label("Music is paused, cannot skip")
     except Exception as e:
         update_error_label(f"Error skipping song: {str(e)}")
         log_to_file(f"Error skipping song: {str(e)}")
 
+# Skips from the button or the control API count against the song that was cut
+# short; skips past a song that already ended do not
+async def user_skip_song():
+    if current_song and not music_paused and pygame.mixer.music.get_busy():
+        play_stats.record(current_song, PLAY_SKIPPED)
+    await skip_song()
+
+def prefetch_file(path):
+    try:
+        with open(path, 'rb') as f:
+            remaining = PREFETCH_LIMIT
+            while remaining > 0 and f.read(PREFETCH_CHUNK):
+                remaining -= PREFETCH_CHUNK
+    except OSError as e:
+        log_to_file(f"Error prefetching song: {str(e)}")
+
+# The next track is picked as soon as the current one starts, read into the
+# page cache off the UI thread and then handed to the mixer's queue, so the
+# switch happens inside SDL without waiting for the next tick or a cold disk
+def prepare_next_song():
+    global next_song, next_song_generation, next_song_draws
+    next_song_generation += 1
+    generation = next_song_generation
+    next_song = None
+    next_song_draws = []
+    bags = (library_shuffle, playlist_shuffle)
+    for bag in bags:
+        bag.last = None
+    try:
+        next_song = choose_next_song()
+    except (IndexError, ZeroDivisionError):
+        return
+    next_song_draws = [(bag,) + bag.last for bag in bags if bag.last is not None]
+    song = next_song
+    run_in_background(lambda: prefetch_file(song), lambda result: queue_next_song(song, generation))
+
+def queue_next_song(song, generation):
+    global queued_song
+    if generation != next_song_generation or not gapless_enabled or not pygame.mixer.music.get_busy():
+        return
+    try:
+        pygame.mixer.music.queue(song)
+        queued_song = song
+    except pygame.error as e:
+        log_to_file(f"Error queueing song: {str(e)}")
+
+# A pick that is replaced before it plays goes back into its bag, so it still
+# comes up this cycle
+def invalidate_next_song():
+    if current_song is not None:
+        for bag, index, epoch in next_song_draws:
+            bag.put_back(index, epoch)
+        prepare_next_song()
+
+def handle_music_end():
+    global queued_song, skip_count
+    if queued_song is not None:
+        song = queued_song
+        queued_song = None
+        skip_count += 1
+        apply_track_gain(song)
+        song_started(song)
+        prepare_next_song()
+    elif not music_paused and not pygame.mixer.music.get_busy():
+        skip_when_idle()
+
 def change_dir():
     global current_dir, song_files, song_count, skip_count, start_time
     try:
         current_dir = filedialog.askdirectory()
-        asyncio.run(load_songs_from_directory(current_dir))
+        run_async(load_songs_from_directory(current_dir), "Error changing directory")
     except Exception as e:
         update_error_label(f"Error changing directory: {str(e)}")
         log_to_file(f"Error changing directory: {str(e)}")
 
 def update_status_label(text):
     global reset_status_job
-    status_label.config(text=text)
     print_and_flush(text)
+    if root is None:
+        return
+    status_label.config(text=text)
     if reset_status_job:
         root.after_cancel(reset_status_job)
     reset_status_job = root.after(10000, lambda: status_label.config(text=ORIGINAL_TITLE))
 
 def update_error_label(text):
-    error_label.config(text=text, fg="yellow")
-    print_and_flush(text)
-    root.after(5000, clear_error_label)
+    print_and_flush(text, logging.WARNING)
+    if root is not None:
+        error_label.config(text=text, fg="yellow")
+        root.after(5000, clear_error_label)
     update_status_label(text)
 
 def clear_error_label():
@@ -256,27 +2157,385 @@ def update_info_label():
     else:
         running_time = datetime.timedelta(seconds=0)
     info_text = f"Song Count: {song_count}, Skip Count: {skip_count}, Current Time: {datetime.datetime.now().strftime('%I:%M %p')}, Date: {datetime.datetime.now().strftime('%m/%d/%Y')}, Running Time: {str(running_time).split('.')[0]}"
-    info_label.config(text=info_text, fg="lightgray", font=("Courier", 10))
-    print_and_flush(info_text)
+    if library_loading:
+        info_text += f", Scanning: {len(song_files)} songs"
+    if root is not None:
+        info_label.config(text=info_text, fg="lightgray", font=("Courier", 10))
+    print_and_flush(info_text, logging.DEBUG)
+
+# Every track that starts is appended to the history table, which keeps the
+# last HISTORY_LIMIT plays across restarts. Only the newest HISTORY_MEMORY
+# entries are held in memory; stepping back past them reads one row at a time.
+class PlaybackHistory:
+    def __init__(self):
+        self.recent = deque(maxlen=HISTORY_MEMORY)
+        self.next_seq = 1
+        # seq of the entry playing while stepping back, None at the newest play
+        self.cursor = None
+        self.conn = None
+
+    def load(self):
+        try:
+            conn = open_library_db()
+            try:
+                rows = conn.execute("SELECT seq, path FROM history ORDER BY seq DESC LIMIT ?", (HISTORY_MEMORY,)).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            log_to_file(f"Error loading playback history: {str(e)}")
+            return
+        self.recent.extend((seq, track_id(path)) for seq, path in reversed(rows))
+        if rows:
+            self.next_seq = rows[0][0] + 1
+
+    def record(self, path):
+        track = track_id(path)
+        self.cursor = None
+        if self.recent and self.recent[-1][1] == track:
+            return
+        seq = self.next_seq
+        self.next_seq += 1
+        self.recent.append((seq, track))
+        history_executor.submit(self.write, seq, path)
+
+    def last(self, count):
+        return {track for seq, track in itertools.islice(reversed(self.recent), count)}
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = open_library_db()
+        return self.conn
+
+    def write(self, seq, path):
+        try:
+            conn = self.connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO history (seq, path) VALUES (?, ?)", (seq, path))
+                conn.execute("DELETE FROM history WHERE seq <= ?", (seq - HISTORY_LIMIT,))
+        except sqlite3.Error as e:
+            log_to_file(f"Error saving playback history: {str(e)}")
+
+    def lookup(self, seq):
+        try:
+            return self.connection().execute("SELECT seq, path FROM history WHERE seq < ? ORDER BY seq DESC LIMIT 1", (seq,)).fetchone()
+        except sqlite3.Error as e:
+            log_to_file(f"Error reading playback history: {str(e)}")
+            return None
+
+    # Resolves to (seq, path) of the play before the current one, or None at
+    # the start of the history
+    async def previous(self):
+        if self.cursor is not None:
+            start = self.cursor
+        elif self.recent:
+            start = self.recent[-1][0]
+        else:
+            return None
+        for seq, track in reversed(self.recent):
+            if seq < start:
+                return seq, track_path(track)
+        if self.recent and self.recent[0][0] == 1:
+            return None
+        return await event_loop.run_in_executor(history_executor, self.lookup, start)
+
+    def close(self):
+        history_executor.submit(self.disconnect).result()
+
+    def disconnect(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+playback_history = PlaybackHistory()
+
+async def step_back():
+    entry = await playback_history.previous()
+    if entry is None:
+        update_status_label("No earlier songs in the history")
+        return
+    playback_history.cursor = entry[0]
+    await play_song(entry[1], record=False)
 
 def prev_song():
-    global prev_songs
-    try:
-        if len(prev_songs) > 1:
-            prev_songs.pop()
-            asyncio.run(play_song(prev_songs[-1]))
-    except Exception as e:
-        update_error_label(f"Error playing previous song: {str(e)}")
-        log_to_file(f"Error playing previous song: {str(e)}")
+    run_async(step_back(), "Error playing previous song")
+
+# Every start and every user skip is appended to PLAY_LOG_FILE as a fixed-size
+# record of time, track key and event, with keys mapped to paths in the
+# play_tracks table. Every PLAY_STATS_BATCH events, and before each query,
+# the records past the last folded offset are added into play_stats, so
+# queries read the per-track summary and never rescan the log.
+PLAY_RECORD = struct.Struct("<dIB")
+PLAY_STARTED = 1
+PLAY_SKIPPED = 2
+
+class PlayStats:
+    def __init__(self):
+        self.conn = None
+        self.log = None
+        self.keys = {}
+        self.pending = 0
+
+    def record(self, path, event):
+        stats_executor.submit(self.append, time.time(), path, event)
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = open_library_db()
+        return self.conn
+
+    def key(self, path):
+        key = self.keys.get(path)
+        if key is None:
+            conn = self.connection()
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO play_tracks (path) VALUES (?)", (path,))
+            key = self.keys[path] = conn.execute("SELECT id FROM play_tracks WHERE path = ?", (path,)).fetchone()[0]
+        return key
+
+    def append(self, when, path, event):
+        try:
+            if self.log is None:
+                self.log = open(PLAY_LOG_FILE, 'ab')
+                # A record cut short by a crash would misalign every later one
+                size = self.log.tell()
+                if size % PLAY_RECORD.size:
+                    self.log.truncate(size - size % PLAY_RECORD.size)
+            self.log.write(PLAY_RECORD.pack(when, self.key(path), event))
+            self.log.flush()
+            self.pending += 1
+            if self.pending >= PLAY_STATS_BATCH:
+                self.materialize()
+        except (OSError, sqlite3.Error) as e:
+            log_to_file(f"Error saving play statistics: {str(e)}")
+
+    def materialize(self):
+        conn = self.connection()
+        row = conn.execute("SELECT offset FROM play_log WHERE id = 0").fetchone()
+        offset = row[0] if row else 0
+        totals = {}
+        try:
+            with open(PLAY_LOG_FILE, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < offset:
+                    # The log was replaced; what it held is already counted
+                    offset = 0
+                f.seek(offset)
+                while True:
+                    data = f.read(PLAY_STATS_CHUNK * PLAY_RECORD.size)
+                    data = data[:len(data) - len(data) % PLAY_RECORD.size]
+                    if not data:
+                        break
+                    offset += len(data)
+                    for when, key, event in PLAY_RECORD.iter_unpack(data):
+                        plays, skips, last_played = totals.get(key, (0, 0, 0))
+                        if event == PLAY_STARTED:
+                            totals[key] = (plays + 1, skips, max(last_played, when))
+                        elif event == PLAY_SKIPPED:
+                            totals[key] = (plays, skips + 1, last_played)
+        except FileNotFoundError:
+            pass
+        with conn:
+            conn.executemany("INSERT INTO play_stats (track, plays, skips, last_played) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (track) DO UPDATE SET plays = plays + excluded.plays, skips = skips + excluded.skips, "
+                             "last_played = MAX(last_played, excluded.last_played)",
+                             [(key,) + total for key, total in totals.items()])
+            conn.execute("INSERT OR REPLACE INTO play_log (id, offset) VALUES (0, ?)", (offset,))
+        self.pending = 0
+
+    def query(self, kind, limit, directory):
+        self.materialize()
+        conn = self.connection()
+        if kind == "top":
+            rows = conn.execute("SELECT t.path, s.plays, s.skips, s.last_played FROM play_stats s "
+                                "JOIN play_tracks t ON t.id = s.track ORDER BY s.plays DESC LIMIT ?", (limit,))
+            return [{"path": path, "plays": plays, "skips": skips, "last_played": last_played or None}
+                    for path, plays, skips, last_played in rows]
+        if kind == "never":
+            if not directory:
+                return []
+            # Walks the library's files in path order, which the primary key index
+            # gives for free, and stops after limit of them
+            rows = conn.execute("SELECT f.path FROM files f WHERE f.path >= ? AND f.path < ? AND NOT EXISTS "
+                                "(SELECT 1 FROM play_tracks t JOIN play_stats s ON s.track = t.id WHERE t.path = f.path AND s.plays > 0) "
+                                "ORDER BY f.path LIMIT ?", library_path_bounds(directory) + (limit,))
+            return [path for path, in rows]
+        if kind == "artists":
+            rows = conn.execute("SELECT COALESCE(g.artist, ''), SUM(s.plays), SUM(s.skips) FROM play_stats s "
+                                "JOIN play_tracks t ON t.id = s.track LEFT JOIN tags g ON g.path = t.path "
+                                "GROUP BY 1 ORDER BY CAST(SUM(s.skips) AS REAL) / MAX(SUM(s.plays), 1) DESC, SUM(s.plays) DESC LIMIT ?", (limit,))
+            return [{"artist": artist, "plays": plays, "skips": skips, "skip_ratio": round(skips / plays, 3) if plays else None}
+                    for artist, plays, skips in rows]
+        raise ValueError(f"Unknown stats query: {kind}")
+
+    def close(self):
+        stats_executor.submit(self.disconnect).result()
+
+    def disconnect(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+play_stats = PlayStats()
+
+def apply_playlist_op(tracks, op):
+    kind = op[0]
+    if kind == "add":
+        tracks.append(op[1])
+    elif kind == "clear":
+        del tracks[:]
+    elif kind == "sort":
+        tracks[:] = array('I', sorted(tracks, key=track_path))
+    elif kind == "reset":
+        tracks[:] = op[1]
+    elif kind == "remove":
+        gone = track_store.under(op[1])
+        remaining = array('I', (track for track in tracks if track not in gone))
+        if len(remaining) == len(tracks):
+            return False
+        tracks[:] = remaining
+    elif kind == "move":
+        moved = moved_tracks(op[1], op[2])
+        if not any(track in moved for track in tracks):
+            return False
+        tracks[:] = array('I', (moved.get(track, track) for track in tracks))
+    return True
+
+# Playlist edits are appended to a journal next to the snapshot file, one JSON
+# line each, and replayed on top of the snapshot when loading. The worker keeps
+# its own copy of the playlist, so once the journal passes PLAYLIST_JOURNAL_LIMIT
+# lines it writes a fresh snapshot and starts over without involving the UI.
+# A journal whose header names a different snapshot is left over from an
+# interrupted compaction and is ignored.
+class PlaylistJournal:
+    def __init__(self, snapshot_file):
+        self.snapshot_file = snapshot_file
+        self.journal_file = os.path.splitext(snapshot_file)[0] + ".journal"
+        self.attached = False
+        self.pending = []
+        self.tracks = None
+        self.entries = 0
+        self.stale = False
+
+    def snapshot_stamp(self):
+        try:
+            stat = os.stat(self.snapshot_file)
+            return [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            return None
+
+    def read(self):
+        tracks = array('I')
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                tracks.extend(map(track_id, json.load(f)))
+        try:
+            with open(self.journal_file, 'r') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return tracks, None
+        try:
+            if not lines or json.loads(lines[0]) != {"snapshot": self.snapshot_stamp()}:
+                return tracks, None
+        except ValueError:
+            return tracks, None
+        entries = 0
+        for line in lines[1:]:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                break
+            if op[0] == "add":
+                op[1] = track_id(op[1])
+            apply_playlist_op(tracks, op)
+            entries += 1
+        return tracks, entries
+
+    # Ties the journal to a playlist that matches what is on disk; entries is
+    # None when there is no usable journal and the next write has to compact
+    def attach(self, tracks, entries):
+        self.attached = True
+        self.pending = []
+        playlist_executor.submit(self.start, array('I', tracks), entries)
+
+    def start(self, tracks, entries):
+        self.tracks = tracks
+        self.entries = entries or 0
+        self.stale = entries is None
+
+    def record(self, op, tracks):
+        if not self.attached:
+            return
+        if op[0] == "reset" or len(self.pending) >= PLAYLIST_JOURNAL_LIMIT:
+            self.pending = [("reset", array('I', tracks))]
+        else:
+            self.pending.append(op)
+
+    def flush(self, tracks, snapshot=False):
+        if snapshot or not self.attached:
+            self.attached = True
+            self.pending = [("reset", array('I', tracks))]
+        ops, self.pending = self.pending, []
+        return playlist_executor.submit(self.write, ops)
+
+    def write(self, ops):
+        lines = []
+        for op in ops:
+            if op[0] == "reset":
+                self.tracks = op[1]
+                self.stale = True
+                lines = []
+            else:
+                apply_playlist_op(self.tracks, op)
+                lines.append(json.dumps(["add", track_path(op[1])] if op[0] == "add" else list(op)))
+        started = time.perf_counter() if instrumentation_enabled and (lines or self.stale) else None
+        try:
+            if self.stale or self.entries + len(lines) > PLAYLIST_JOURNAL_LIMIT:
+                self.compact()
+            elif lines:
+                with open(self.journal_file, 'a') as f:
+                    f.write("".join(line + "\n" for line in lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.entries += len(lines)
+            if started is not None:
+                record_latency("playlist_write", started)
+        except OSError as e:
+            self.stale = True
+            log_to_file(f"Error saving playlist: {str(e)}")
+
+    def compact(self):
+        self.stale = True
+        write_file_atomically(self.snapshot_file, json.dumps([track_path(track) for track in self.tracks]))
+        write_file_atomically(self.journal_file, json.dumps({"snapshot": self.snapshot_stamp()}) + "\n")
+        self.entries = 0
+        self.stale = False
+
+playlist_journal = PlaylistJournal(PLAYLIST_FILE)
+playlist_export = PlaylistJournal(os.path.join(DOCUMENTS_DIR, 'playlist.json'))
+
+# Every playlist change goes through here so that both journals see it
+def edit_playlist(*op):
+    global playlist_modified
+    before = array('I', playlist) if op[0] in ("sort", "remove", "move") else None
+    if not apply_playlist_op(playlist, op):
+        return False
+    if before is not None:
+        playlist_shuffle.rebuild(before, playlist, moved_tracks(op[1], op[2]) if op[0] == "move" else None)
+    playlist_journal.record(op, playlist)
+    playlist_export.record(op, playlist)
+    playlist_modified = True
+    schedule_settings_flush()
+    return True
 
 def save_song():
     global current_song, playlist, playlist_modified
     try:
         if current_song:
-            playlist.append(current_song)
-            playlist_modified = True
-            update_playlist()
-            save_settings()
+            edit_playlist("add", track_id(current_song))
+            playlist_changed()
             update_status_label("Song Saved")
     except Exception as e:
         update_error_label(f"Error saving song: {str(e)}")
@@ -285,10 +2544,9 @@ def save_song():
 def clear_playlist():
     global playlist, playlist_modified
     try:
-        playlist = []
-        playlist_modified = True
-        update_playlist()
-        save_settings()
+        edit_playlist("clear")
+        playlist_shuffle.reset()
+        playlist_changed()
         update_status_label("Playlist Cleared")
     except Exception as e:
         update_error_label(f"Error clearing playlist: {str(e)}")
@@ -297,10 +2555,11 @@ def clear_playlist():
 def shuffle_playlist():
     global playlist, playlist_modified
     try:
-        random.shuffle(playlist)
-        playlist_modified = True
-        update_playlist()
-        save_settings()
+        shuffled = array('I', playlist)
+        random.shuffle(shuffled)
+        edit_playlist("reset", shuffled)
+        playlist_shuffle.reset()
+        playlist_changed()
         update_status_label("Playlist Shuffled")
     except Exception as e:
         update_error_label(f"Error shuffling playlist: {str(e)}")
@@ -310,7 +2569,10 @@ def toggle_repeat():
     global repeat_enabled
     try:
         repeat_enabled = not repeat_enabled
-        repeat_button.config(text="Repeat: On" if repeat_enabled else "Repeat: Off", fg="green" if repeat_enabled else "red")
+        state_changed()
+        if root is not None:
+            repeat_button.config(text="Repeat: On" if repeat_enabled else "Repeat: Off", fg="green" if repeat_enabled else "red")
+        invalidate_next_song()
         update_status_label("Repeat " + ("Enabled" if repeat_enabled else "Disabled"))
     except Exception as e:
         update_error_label(f"Error toggling repeat: {str(e)}")
@@ -320,7 +2582,10 @@ def toggle_playlist_only_mode():
     global playlist_only_mode
     try:
         playlist_only_mode = not playlist_only_mode
-        playlist_only_button.config(text="Playlist Only: On" if playlist_only_mode else "Playlist Only: Off", fg="green" if playlist_only_mode else "red")
+        state_changed()
+        if root is not None:
+            playlist_only_button.config(text="Playlist Only: On" if playlist_only_mode else "Playlist Only: Off", fg="green" if playlist_only_mode else "red")
+        invalidate_next_song()
         update_status_label("Playlist Only " + ("Enabled" if playlist_only_mode else "Disabled"))
     except Exception as e:
         update_error_label(f"Error toggling playlist-only mode: {str(e)}")
@@ -330,11 +2595,14 @@ def toggle_playlist_only_not_random_mode():
     global playlist_only_not_random_mode
     try:
         playlist_only_not_random_mode = not playlist_only_not_random_mode
-        playlist_only_not_random_button.config(text="Playlist Only Not Random: On" if playlist_only_not_random_mode else "Playlist Only Not Random: Off", fg="green" if playlist_only_not_random_mode else "red")
+        state_changed()
+        if root is not None:
+            playlist_only_not_random_button.config(text="Playlist Only Not Random: On" if playlist_only_not_random_mode else "Playlist Only Not Random: Off", fg="green" if playlist_only_not_random_mode else "red")
+        invalidate_next_song()
         if playlist_only_not_random_mode:
             auto_save_playlist()
-        else:
-            root.after_cancel(auto_save_job)
+        elif auto_save_job:
+            cancel_call(auto_save_job)
         update_status_label("Playlist Only Not Random " + ("Enabled" if playlist_only_not_random_mode else "Disabled"))
     except Exception as e:
         update_error_label(f"Error toggling playlist-only not random mode: {str(e)}")
@@ -343,26 +2611,97 @@ def toggle_playlist_only_not_random_mode():
 def auto_save_playlist():
     global auto_save_job
     if playlist_only_not_random_mode:
-        save_playlist_to_file()
-        auto_save_job = root.after(30000, auto_save_playlist)
+        save_playlist_to_file(snapshot=False)
+        auto_save_job = schedule_call(30000, auto_save_playlist)
 
 def toggle_dir_select_not_random_mode():
     global dir_select_not_random_mode
     try:
         dir_select_not_random_mode = not dir_select_not_random_mode
-        dir_select_not_random_button.config(text="Dir Select Not Random: On" if dir_select_not_random_mode else "Dir Select Not Random: Off", fg="green" if dir_select_not_random_mode else "red")
+        state_changed()
+        if root is not None:
+            dir_select_not_random_button.config(text="Dir Select Not Random: On" if dir_select_not_random_mode else "Dir Select Not Random: Off", fg="green" if dir_select_not_random_mode else "red")
+        invalidate_next_song()
         update_status_label("Dir Select Not Random " + ("Enabled" if dir_select_not_random_mode else "Disabled"))
     except Exception as e:
         update_error_label(f"Error toggling directory-select not random mode: {str(e)}")
         log_to_file(f"Error toggling directory-select not random mode: {str(e)}")
 
-def save_playlist_to_file():
+def toggle_watch_library_mode():
+    global watch_library_enabled
+    try:
+        watch_library_enabled = not watch_library_enabled
+        state_changed()
+        if root is not None:
+            watch_library_button.config(text="Watch Dir: On" if watch_library_enabled else "Watch Dir: Off", fg="green" if watch_library_enabled else "red")
+        if watch_library_enabled and current_dir:
+            start_library_watcher(current_dir)
+        elif not watch_library_enabled:
+            stop_library_watcher()
+        save_settings()
+        update_status_label("Watch Dir " + ("Enabled" if watch_library_enabled else "Disabled"))
+    except Exception as e:
+        update_error_label(f"Error toggling directory watching: {str(e)}")
+        log_to_file(f"Error toggling directory watching: {str(e)}")
+
+def toggle_normalize_mode():
+    global normalize_enabled
+    try:
+        if not normalize_enabled and not analysis_available():
+            update_error_label("Normalize needs NumPy ('pip install numpy') and ffmpeg on the PATH")
+            return
+        normalize_enabled = not normalize_enabled
+        state_changed()
+        if root is not None:
+            normalize_button.config(text="Normalize: On" if normalize_enabled else "Normalize: Off", fg="green" if normalize_enabled else "red")
+        start_loudness_refresh(current_dir)
+        apply_track_gain(current_song)
+        save_settings()
+        update_status_label("Normalize " + ("Enabled" if normalize_enabled else "Disabled"))
+    except Exception as e:
+        update_error_label(f"Error toggling volume normalization: {str(e)}")
+        log_to_file(f"Error toggling volume normalization: {str(e)}")
+
+def toggle_skip_duplicates_mode():
+    global skip_duplicates_enabled
+    try:
+        skip_duplicates_enabled = not skip_duplicates_enabled
+        state_changed()
+        if root is not None:
+            skip_duplicates_button.config(text="Skip Duplicates: On" if skip_duplicates_enabled else "Skip Duplicates: Off", fg="green" if skip_duplicates_enabled else "red")
+        start_duplicate_scan(current_dir)
+        invalidate_next_song()
+        save_settings()
+        update_status_label("Skip Duplicates " + ("Enabled" if skip_duplicates_enabled else "Disabled"))
+    except Exception as e:
+        update_error_label(f"Error toggling duplicate skipping: {str(e)}")
+        log_to_file(f"Error toggling duplicate skipping: {str(e)}")
+
+def toggle_smart_shuffle_mode():
+    global smart_shuffle_enabled
+    try:
+        if not smart_shuffle_enabled and not analysis_available():
+            update_error_label("Smart Shuffle needs NumPy ('pip install numpy') and ffmpeg on the PATH")
+            return
+        smart_shuffle_enabled = not smart_shuffle_enabled
+        state_changed()
+        if root is not None:
+            smart_shuffle_button.config(text="Smart Shuffle: On" if smart_shuffle_enabled else "Smart Shuffle: Off", fg="green" if smart_shuffle_enabled else "red")
+        start_feature_refresh(current_dir)
+        invalidate_next_song()
+        save_settings()
+        update_status_label("Smart Shuffle " + ("Enabled" if smart_shuffle_enabled else "Disabled"))
+    except Exception as e:
+        update_error_label(f"Error toggling smart shuffle: {str(e)}")
+        log_to_file(f"Error toggling smart shuffle: {str(e)}")
+
+# An explicit save writes a complete playlist.json; autosaves only append the
+# edits made since the last save to its journal
+def save_playlist_to_file(snapshot=True):
     global playlist, playlist_modified
     try:
         if playlist_modified:
-            documents_dir = os.path.expanduser("~/Documents")
-            with open(os.path.join(documents_dir, 'playlist.json'), 'w') as f:
-                json.dump(playlist, f)
+            playlist_export.flush(playlist, snapshot)
             playlist_modified = False
             update_status_label("Playlist saved to file")
     except Exception as e:
@@ -370,58 +2709,200 @@ def save_playlist_to_file():
         log_to_file(f"Error saving playlist: {str(e)}")
 
 def load_playlist_from_file():
-    global playlist
+    global playlist, playlist_modified
     try:
-        documents_dir = os.path.expanduser("~/Documents")
-        with open(os.path.join(documents_dir, 'playlist.json'), 'r') as f:
-            playlist = json.load(f)
-        update_playlist()
+        tracks, entries = playlist_export.read()
+        edit_playlist("reset", tracks)
+        playlist_export.attach(tracks, entries)
+        playlist_modified = False
+        playlist_shuffle.reset()
+        playlist_changed()
         update_status_label("Playlist loaded from file")
     except Exception as e:
         update_error_label(f"Error loading playlist: {str(e)}")
         log_to_file(f"Error loading playlist: {str(e)}")
 
 def play_selected_song(event):
+    global playlist_selected
     try:
         if playlist_listbox.curselection():
-            selected_song = playlist_listbox.get(playlist_listbox.curselection())
-            asyncio.run(play_song(selected_song))
+            playlist_selected = playlist_view_top + playlist_listbox.curselection()[0]
+            if playlist_selected < len(playlist):
+                run_async(play_song(track_path(playlist[playlist_selected])))
     except Exception as e:
         update_error_label(f"Error playing selected song: {str(e)}")
         log_to_file(f"Error playing selected song: {str(e)}")
 
+def playlist_changed():
+    global playlist_revision
+    playlist_revision += 1
+    if playlist_only_mode:
+        invalidate_next_song()
+    sync_search_index("playlist", playlist)
+    state_changed()
+    request_repaint()
+
+def playlist_visible_rows():
+    height = playlist_listbox.winfo_height()
+    if height <= 1:
+        return PLAYLIST_VISIBLE_ROWS
+    return max(1, height // playlist_line_height + 1)
+
+def playlist_row_text(index):
+    song = track_path(playlist[index])
+    if playlist_search_term:
+        start_idx = song.lower().find(playlist_search_term)
+        if start_idx >= 0:
+            end_idx = start_idx + len(playlist_search_term)
+            return f"{song[:start_idx]}[{song[start_idx:end_idx]}]{song[end_idx:]}"
+    return song
+
+# The listbox only ever holds the rows that are on screen. Nothing is touched
+# unless the playlist revision, scroll position, search or selection changed,
+# and then only the rows whose text differs are replaced.
 def update_playlist():
-    global playlist
+    global playlist_rendered, playlist_view_top, playlist_rows_top
 
+    if root is None:
+        return
+    started = time.perf_counter() if instrumentation_enabled else None
     try:
-        scrollbar_position = scrollbar_y.get()
+        visible = playlist_visible_rows()
+        playlist_view_top = max(0, min(playlist_view_top, len(playlist) - visible + 1))
+        key = (playlist_revision, playlist_view_top, visible, playlist_search_term, playlist_selected)
+        if key == playlist_rendered:
+            return
+        playlist_rendered = key
+
+        rows = [playlist_row_text(index) for index in range(playlist_view_top, min(playlist_view_top + visible, len(playlist)))]
         playlist_listbox.config(bg='black', fg='lightgray')
-        playlist_listbox.delete(0, tk.END)
-        for song in playlist:
-            playlist_listbox.insert(tk.END, song)
-        playlist_listbox.yview_moveto(scrollbar_position[0])
+        shift = playlist_view_top - playlist_rows_top
+        if 0 < shift < len(playlist_rows):
+            playlist_listbox.delete(0, shift - 1)
+            del playlist_rows[:shift]
+        elif 0 < -shift < len(playlist_rows):
+            playlist_listbox.delete(len(playlist_rows) + shift, tk.END)
+            del playlist_rows[shift:]
+            for text in reversed(rows[:-shift]):
+                playlist_listbox.insert(0, text)
+            playlist_rows[:0] = rows[:-shift]
+        playlist_rows_top = playlist_view_top
+        for row, text in enumerate(rows):
+            if row >= len(playlist_rows):
+                playlist_listbox.insert(tk.END, text)
+            elif playlist_rows[row] != text:
+                playlist_listbox.delete(row)
+                playlist_listbox.insert(row, text)
+        if len(playlist_rows) > len(rows):
+            playlist_listbox.delete(len(rows), tk.END)
+        playlist_rows[:] = rows
+
+        playlist_listbox.selection_clear(0, tk.END)
+        if playlist_selected is not None and 0 <= playlist_selected - playlist_view_top < len(rows):
+            playlist_listbox.selection_set(playlist_selected - playlist_view_top)
+        if playlist:
+            scrollbar_y.set(playlist_view_top / len(playlist), (playlist_view_top + len(rows)) / len(playlist))
+        else:
+            scrollbar_y.set(0, 1)
+        if started is not None:
+            record_latency("update_playlist", started)
     except Exception as e:
         update_error_label(f"Error updating playlist: {str(e)}")
         log_to_file(f"Error updating playlist: {str(e)}")
 
+def scroll_playlist(*args):
+    global playlist_view_top
+    if args[0] == "moveto":
+        playlist_view_top = int(float(args[1]) * len(playlist))
+    elif args[0] == "scroll":
+        playlist_view_top += int(args[1]) * (playlist_visible_rows() - 2 if args[2] == "pages" else 1)
+    update_playlist()
+
+def scroll_playlist_to(index):
+    global playlist_view_top
+    visible = playlist_visible_rows()
+    if not playlist_view_top <= index < playlist_view_top + visible - 1:
+        playlist_view_top = max(0, index - visible // 2)
+
+def on_playlist_mousewheel(event):
+    if event.num == 4 or event.delta > 0:
+        scroll_playlist("scroll", -3, "units")
+    else:
+        scroll_playlist("scroll", 3, "units")
+    return "break"
+
+# Only the clock and running time change on their own, so this is all the
+# window does once a second; everything else repaints when it changes
 def update_labels():
+    started = time.perf_counter() if instrumentation_enabled else None
     try:
-        if pygame.mixer.music.get_busy():
-            update_info_label()
-            update_playlist()
-        else:
-            asyncio.run(skip_song())
+        update_info_label()
     except Exception as e:
         update_error_label(f"Error updating labels: {str(e)}")
         log_to_file(f"Error updating labels: {str(e)}")
-    root.after(1000, update_labels)
+    if started is not None:
+        record_latency("update_labels", started)
+    schedule_call(1000 - int(time.time() * 1000) % 1000, update_labels)
+
+# The mixer posts MUSIC_END when a track finishes, so the next one starts
+# within a poll instead of up to a second later. Without the event (no video
+# subsystem), or after a track failed to start, an idle mixer is noticed
+# here too.
+def pump_music_events():
+    try:
+        if gapless_enabled:
+            for event in pygame.event.get(MUSIC_END):
+                handle_music_end()
+        playing = not music_paused and pygame.mixer.music.get_busy()
+        if not music_paused and (song_files or (repeat_enabled and playlist)) and not playing:
+            skip_when_idle()
+    except Exception as e:
+        playing = False
+        update_error_label(f"Error handling the end of a song: {str(e)}")
+        log_to_file(f"Error handling the end of a song: {str(e)}")
+    schedule_call(MUSIC_EVENT_POLL_MS if playing else MUSIC_EVENT_IDLE_POLL_MS, pump_music_events)
+
+def skip_when_idle():
+    global idle_skip_task, idle_skip_at
+    if idle_skip_task is not None and not idle_skip_task.done():
+        return
+    now = time.monotonic()
+    if idle_skip_at is not None and now - idle_skip_at < IDLE_SKIP_INTERVAL:
+        return
+    idle_skip_at = now
+    idle_skip_task = run_async(skip_song())
+
+def request_repaint():
+    global repaint_job
+    if root is None or repaint_job is not None:
+        return
+    repaint_job = root.after_idle(repaint)
+
+def repaint():
+    global repaint_job
+    repaint_job = None
+    update_playlist()
 
 def on_close():
+    global metadata_generation, loudness_generation, feature_generation, duplicate_generation, library_generation, closing
     try:
+        stop_library_watcher()
+        stop_control_servers()
+        closing = True
+        library_generation += 1
+        metadata_generation += 1
+        loudness_generation += 1
+        feature_generation += 1
+        duplicate_generation += 1
+        if analysis_executor is not None:
+            analysis_executor.shutdown(wait=False)
+        flush_settings_now()
         pygame.mixer.music.stop()
         pygame.mixer.quit()
-        root.destroy()
-        save_settings()
+        if root is not None:
+            root.destroy()
+        else:
+            event_loop.stop()
     except Exception as e:
         update_error_label(f"Error closing application: {str(e)}")
         log_to_file(f"Error closing application: {str(e)}")
@@ -432,7 +2913,15 @@ def update_playing_label(song_path):
     filtered_sections = [section for section in sections if section.lower() != 'mnt' and section.lower() != 'hdd' and section.lower() != 'music']
     song_name = filtered_sections[-1].rsplit('.', 1)[0]
     playing_text = " > ".join(filtered_sections[:-1] + [song_name])
-    playing_label.config(text=playing_text)
+    tags = get_track_metadata(song_path)
+    if tags:
+        details = " - ".join(part for part in (tags["artist"], tags["title"]) if part)
+        if tags["duration"]:
+            details = f"{details} [{format_duration(tags['duration'])}]".strip()
+        if details:
+            playing_text += f"  |  {details}"
+    if root is not None:
+        playing_label.config(text=playing_text)
     print_and_flush(f"Playing: {playing_text}")
 
 def drop(event):
@@ -441,48 +2930,474 @@ def drop(event):
         if os.path.isdir(file):
             process_directory(file)
         elif file.endswith(SUPPORTED_FORMATS):
-            playlist.append(file)
-    playlist.sort()
-    update_playlist()
-    save_settings()
+            edit_playlist("add", track_id(file))
+    edit_playlist("sort")
+    playlist_changed()
 
-def process_directory(directory):
-    global playlist
-    song_files = []
-    for root, dirs, files in os.walk(directory):
-        for file in sorted(files):
-            if file.endswith(SUPPORTED_FORMATS):
-                song_files.append(os.path.abspath(os.path.join(root, file)))
+# The scan, the duplicate hashing and the file write run on a worker; only the
+# playlist edits happen on the Tk thread
+def scan_dropped_directory(directory, tracks):
+    song_files = scan_music_tree(directory)
+    if skip_duplicates_enabled:
+        song_files = drop_duplicate_songs(song_files, tracks)
 
     if song_files:
-        documents_dir = os.path.expanduser("~/Documents")
-        playlist_file = os.path.join(documents_dir, 'dropped_playlist.json')
+        playlist_file = os.path.join(DOCUMENTS_DIR, 'dropped_playlist.json')
         with open(playlist_file, 'w') as f:
             json.dump(song_files, f)
-        playlist.extend(song_files)
-        update_playlist()
-        save_settings()
+    return song_files
 
-def search_playlist(event):
-    search_term = search_entry.get().lower()
-    playlist_listbox.delete(0, tk.END)
-    matched_items = []
-
-    for index, song in enumerate(playlist):
-        if search_term in song.lower():
-            start_idx = song.lower().index(search_term)
-            end_idx = start_idx + len(search_term)
-            highlighted_song = f"{song[:start_idx]}[{song[start_idx:end_idx]}]{song[end_idx:]}"
-            playlist_listbox.insert(tk.END, highlighted_song)
-            matched_items.append(index)
+def add_dropped_songs(song_files):
+    if song_files:
+        for song in song_files:
+            edit_playlist("add", track_id(song))
+        edit_playlist("sort")
+        playlist_changed()
+
+def process_directory(directory):
+    tracks = array('I', playlist) if skip_duplicates_enabled else array('I')
+    return run_in_background(lambda: scan_dropped_directory(directory, tracks), add_dropped_songs)
+
+# Timers go through Tk when there is a window and straight to the event loop
+# in headless mode
+def schedule_call(ms, func):
+    if root is None:
+        return event_loop.call_later(ms / 1000, func)
+    return root.after(ms, func)
+
+def cancel_call(job):
+    if root is None:
+        job.cancel()
+    else:
+        root.after_cancel(job)
+
+def pump_event_loop():
+    global event_loop_job
+    event_loop_job = None
+    event_loop.call_soon(event_loop.stop)
+    event_loop.run_forever()
+    event_loop_job = root.after(event_loop_pump_delay(), pump_event_loop)
+
+# A task in flight waits on a worker thread or a socket, which only the loop's
+# own poll notices, so it is pumped every EVENT_LOOP_PUMP_MS. Otherwise the
+# pump sleeps until the loop's next timer (asyncio keeps them in a heap it
+# does not expose), for EVENT_LOOP_IDLE_MS at most.
+def event_loop_pump_delay():
+    if any(not task.done() for task in asyncio.all_tasks(event_loop)):
+        return EVENT_LOOP_PUMP_MS
+    scheduled = getattr(event_loop, "_scheduled", None)
+    if scheduled:
+        due = int((scheduled[0].when() - event_loop.time()) * 1000)
+        return max(EVENT_LOOP_PUMP_MS, min(due, EVENT_LOOP_IDLE_MS))
+    return EVENT_LOOP_IDLE_MS
+
+# Work started from Tk should not wait out an idle pump
+def wake_event_loop():
+    global event_loop_job
+    if root is not None and event_loop_job is not None:
+        root.after_cancel(event_loop_job)
+        event_loop_job = root.after_idle(pump_event_loop)
+
+def report_task_error(task, error_text):
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        update_error_label(f"{error_text}: {str(e)}")
+        log_to_file(f"{error_text}: {str(e)}")
+
+def run_async(coro, error_text="Error in background task"):
+    task = event_loop.create_task(coro)
+    task.add_done_callback(lambda task: report_task_error(task, error_text))
+    wake_event_loop()
+    return task
+
+def run_in_background(func, callback, pool=executor):
+    async def runner():
+        callback(await event_loop.run_in_executor(pool, func))
+
+    return run_async(runner())
+
+def path_trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# Trigram index over the library and the playlist. Each source is synced with
+# a snapshot of its track ids, only tracks that appeared are tokenized and
+# tracks that disappeared are dropped lazily until enough pile up to compact.
+class SearchIndex:
+    def __init__(self):
+        self.counts = {"library": Counter(), "playlist": Counter()}
+        self.indexed = set()
+        self.grams = {}
+        self.dropped = 0
+
+    def add_track(self, track):
+        self.indexed.add(track)
+        for gram in path_trigrams(track_path(track).lower()):
+            posting = self.grams.get(gram)
+            if posting is None:
+                self.grams[gram] = posting = array('I')
+            posting.append(track)
+
+    def compact(self):
+        live = self.indexed
+        self.indexed = set()
+        self.grams = {}
+        self.dropped = 0
+        for track in live:
+            self.add_track(track)
+
+    def sync(self, source, tracks):
+        old_counts = self.counts[source]
+        new_counts = Counter(tracks)
+        self.counts[source] = new_counts
+        for track in new_counts.keys() - old_counts.keys():
+            if track not in self.indexed:
+                self.add_track(track)
+        for track in old_counts.keys() - new_counts.keys():
+            if not any(track in counts for counts in self.counts.values()):
+                self.indexed.discard(track)
+                self.dropped += 1
+        if self.dropped > 1000 and self.dropped * 3 > len(self.indexed):
+            self.compact()
+
+    def search(self, term):
+        if len(term) < 3:
+            candidates = self.indexed
         else:
-            playlist_listbox.insert(tk.END, song)
+            postings = []
+            for gram in path_trigrams(term):
+                posting = self.grams.get(gram)
+                if posting is None:
+                    return set(), 0
+                postings.append(posting)
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                # Everything is verified below, so huge postings are not worth intersecting
+                if not candidates or len(posting) > len(candidates) * 8:
+                    break
+                candidates.intersection_update(posting)
+        matches = {track for track in candidates if track in self.indexed and term in track_path(track).lower()}
+        playlist_matches = {track for track in matches if track in self.counts["playlist"]}
+        library_count = sum(1 for track in matches if track in self.counts["library"])
+        return playlist_matches, library_count
+
+search_index = SearchIndex()
+
+def sync_search_index(source, tracks):
+    search_executor.submit(search_index.sync, source, array('I', tracks))
+
+def search_playlist(event):
+    global search_job
+    if search_job:
+        root.after_cancel(search_job)
+    search_job = root.after(SEARCH_DEBOUNCE_MS, run_playlist_search)
+
+def run_playlist_search():
+    global search_job, search_generation, playlist_search_term, playlist_selected
+    search_job = None
+    search_generation += 1
+    generation = search_generation
+    term = search_entry.get().lower()
+    if not term:
+        playlist_search_term = ""
+        playlist_selected = None
+        update_playlist()
+        return
+
+    snapshot = array('I', playlist)
+    run_in_background(lambda: find_search_matches(search_index, term, snapshot),
+                      lambda result: show_search_result(generation, term, *result), pool=search_executor)
+
+def find_search_matches(index, term, snapshot):
+    matches, library_count = index.search(term)
+    first = None
+    count = 0
+    for position, song in enumerate(snapshot):
+        if song in matches:
+            count += 1
+            if first is None:
+                first = position
+    return first, count, library_count
+
+def show_search_result(generation, term, first, count, library_count):
+    global playlist_search_term, playlist_selected
+    if generation != search_generation:
+        return
+    playlist_search_term = term
+    playlist_selected = first
+    if first is not None:
+        scroll_playlist_to(first)
+    update_playlist()
+    update_status_label(f"Search: {count} in playlist, {library_count} in library")
 
-    if matched_items:
-        playlist_listbox.selection_set(matched_items[0])
-        playlist_listbox.see(matched_items[0])
+def player_state():
+    return {
+        "current_song": current_song,
+        "playing": pygame.mixer.music.get_busy(),
+        "paused": music_paused,
+        "volume": volume_level,
+        "song_count": song_count,
+        "skip_count": skip_count,
+        "directory": current_dir,
+        "library_size": len(song_files),
+        "library_loading": library_loading,
+        "playlist_size": len(playlist),
+        "repeat": repeat_enabled,
+        "playlist_only": playlist_only_mode,
+        "playlist_only_not_random": playlist_only_not_random_mode,
+        "dir_select_not_random": dir_select_not_random_mode,
+        "watch_dir": watch_library_enabled,
+        "normalize": normalize_enabled,
+        "skip_duplicates": skip_duplicates_enabled,
+        "duplicates": len(duplicate_tracks),
+        "smart_shuffle": smart_shuffle_enabled,
+        "analyzed": len(feature_index.tracks) if feature_index is not None else 0
+    }
+
+# Subscribers get at most one state push per trip through the event loop, no
+# matter how many things changed in between
+def state_changed():
+    global state_broadcast_pending
+    if control_subscribers and not state_broadcast_pending:
+        state_broadcast_pending = True
+        event_loop.call_soon(broadcast_state)
+
+def broadcast_state():
+    global state_broadcast_pending
+    state_broadcast_pending = False
+    state = player_state()
+    for push in list(control_subscribers):
+        push(state)
+
+# A subscriber that stops reading is dropped rather than buffered without limit
+def add_control_subscriber(writer, encode):
+    def push(state):
+        if writer.transport.is_closing() or writer.transport.get_write_buffer_size() > CONTROL_BUFFER_LIMIT:
+            control_subscribers.discard(push)
+            writer.close()
+        else:
+            writer.write(encode(state))
+
+    control_subscribers.add(push)
+    push(player_state())
+    return push
+
+def set_control_mode(command, enabled, toggle):
+    if command.get("enabled") is None or bool(command["enabled"]) != enabled:
+        toggle()
+
+def control_add(command):
+    paths = command.get("paths") or [command["path"]]
+    for path in paths:
+        edit_playlist("add", track_id(os.path.abspath(path)))
+    playlist_changed()
+
+def control_playlist(command):
+    offset = int(command.get("offset", 0))
+    limit = int(command.get("limit", 1000))
+    return [track_path(track) for track in playlist[offset:offset + limit]]
+
+async def control_play(command):
+    if "index" in command:
+        await play_song(track_path(playlist[int(command["index"])]))
     else:
-        playlist_listbox.selection_clear(0, tk.END)
+        await play_song(os.path.abspath(command["path"]))
+
+# set_volume reports its own errors on the status line, so the level is
+# checked here to give the caller an error reply instead
+def control_volume(command):
+    try:
+        level = int(command["level"])
+    except (TypeError, ValueError):
+        raise ValueError(f"Volume level must be a whole number from 0 to 120, not {command['level']!r}")
+    set_volume(min(120, max(0, level)))
+
+async def control_stats(command):
+    directory = os.path.abspath(current_dir) if current_dir else ""
+    return await event_loop.run_in_executor(stats_executor, play_stats.query, command.get("query", "top"), int(command.get("limit", 20)), directory)
+
+async def control_load_dir(command):
+    global current_dir
+    current_dir = command["path"]
+    await load_songs_from_directory(current_dir)
+
+CONTROL_COMMANDS = {
+    "state": lambda command: None,
+    "skip": lambda command: user_skip_song(),
+    "prev": lambda command: step_back(),
+    "pause": lambda command: pause_music(),
+    "unpause": lambda command: unpause_music(),
+    "volume": control_volume,
+    "save": lambda command: save_song(),
+    "clear": lambda command: clear_playlist(),
+    "shuffle": lambda command: shuffle_playlist(),
+    "add": control_add,
+    "playlist": control_playlist,
+    "play": control_play,
+    "load_dir": control_load_dir,
+    "metrics": lambda command: metrics_prometheus() if command.get("format") == "prometheus" else metrics_snapshot(),
+    "startup": lambda command: dict(startup_phases),
+    "stats": control_stats,
+    "repeat": lambda command: set_control_mode(command, repeat_enabled, toggle_repeat),
+    "playlist_only": lambda command: set_control_mode(command, playlist_only_mode, toggle_playlist_only_mode),
+    "playlist_only_not_random": lambda command: set_control_mode(command, playlist_only_not_random_mode, toggle_playlist_only_not_random_mode),
+    "dir_select_not_random": lambda command: set_control_mode(command, dir_select_not_random_mode, toggle_dir_select_not_random_mode),
+    "watch_dir": lambda command: set_control_mode(command, watch_library_enabled, toggle_watch_library_mode),
+    "normalize": lambda command: set_control_mode(command, normalize_enabled, toggle_normalize_mode),
+    "skip_duplicates": lambda command: set_control_mode(command, skip_duplicates_enabled, toggle_skip_duplicates_mode),
+    "smart_shuffle": lambda command: set_control_mode(command, smart_shuffle_enabled, toggle_smart_shuffle_mode)
+}
+
+# Commands are JSON objects like {"id": 1, "cmd": "volume", "level": 40}. The
+# reply echoes the id and carries the player state, or the command's own
+# result for queries like "playlist". A "batch" runs its "commands" in order
+# and replies with one entry per command.
+async def run_control_command(command):
+    try:
+        name = command.get("cmd")
+        if name == "batch":
+            result = [await run_control_command(sub_command) for sub_command in command["commands"]]
+        elif name in CONTROL_COMMANDS:
+            result = CONTROL_COMMANDS[name](command)
+            if asyncio.iscoroutine(result):
+                result = await result
+            if result is None:
+                result = player_state()
+        else:
+            raise ValueError(f"Unknown command: {name}")
+        reply = {"ok": True, "result": result}
+    except Exception as e:
+        reply = {"ok": False, "error": str(e)}
+    if isinstance(command, dict) and "id" in command:
+        reply["id"] = command["id"]
+    return reply
+
+def encode_state_line(state):
+    return (json.dumps({"event": "state", "state": state}) + "\n").encode()
+
+# One JSON command per line in, one JSON reply per line out. {"cmd": "subscribe"}
+# turns the connection into a state stream as well.
+async def handle_control_connection(reader, writer):
+    push = None
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                command = json.loads(line)
+            except ValueError as e:
+                reply = {"ok": False, "error": f"Invalid JSON: {str(e)}"}
+            else:
+                if isinstance(command, dict) and command.get("cmd") == "subscribe":
+                    if push is None:
+                        push = add_control_subscriber(writer, encode_state_line)
+                    reply = {"ok": True, "result": None}
+                    if "id" in command:
+                        reply["id"] = command["id"]
+                else:
+                    reply = await run_control_command(command)
+            writer.write((json.dumps(reply) + "\n").encode())
+            await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        control_subscribers.discard(push)
+        writer.close()
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 415: "Unsupported Media Type"}
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "[::1]")
+
+# Browsers add an Origin header to cross-origin requests and cannot send a JSON
+# content type without a preflight, and a rebound DNS name shows up in Host, so
+# these keep web pages from driving the player
+def refuse_control_request(method, headers):
+    if "origin" in headers:
+        return 403, "Cross-origin requests are not allowed"
+    host = headers.get("host", "")
+    if not host.endswith("]"):
+        host = host.rpartition(":")[0] or host
+    if host not in LOOPBACK_HOSTS:
+        return 403, "Host must be a loopback address"
+    if method == "POST" and headers.get("content-type", "").split(";")[0].strip().lower() != "application/json":
+        return 415, "Content-Type must be application/json"
+    return None
+
+# GET /state, POST /command with a command as the body, and GET /subscribe as
+# a server-sent event stream of states
+async def handle_control_http(reader, writer):
+    push = None
+    try:
+        request_line = (await reader.readline()).decode("latin-1")
+        method, target = request_line.split()[:2]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if not line.strip():
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        path = target.split("?")[0]
+        refused = refuse_control_request(method, headers)
+        if refused is not None:
+            status, reply = refused[0], {"ok": False, "error": refused[1]}
+        elif method == "GET" and path == "/subscribe":
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+            push = add_control_subscriber(writer, lambda state: f"data: {json.dumps(state)}\n\n".encode())
+            await reader.read()
+            writer.close()
+            return
+        elif method == "GET" and path == "/state":
+            status, reply = 200, {"ok": True, "result": player_state()}
+        elif method == "POST" and path == "/command":
+            reply = await run_control_command(json.loads(body))
+            status = 200 if reply["ok"] else 400
+        else:
+            status, reply = 404, {"ok": False, "error": "Not found"}
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        status, reply = 400, {"ok": False, "error": str(e)}
+    except ConnectionError:
+        writer.close()
+        return
+    finally:
+        control_subscribers.discard(push)
+    try:
+        data = json.dumps(reply).encode()
+        writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_control_servers():
+    if args.control_socket:
+        if not hasattr(asyncio, "start_unix_server"):
+            update_error_label("Unix domain sockets are not supported on this system")
+        else:
+            path = os.path.abspath(args.control_socket)
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+            server = await asyncio.start_unix_server(handle_control_connection, path=path, limit=CONTROL_LINE_LIMIT)
+            os.chmod(path, 0o600)
+            control_servers.append(server)
+    if args.control_port:
+        server = await asyncio.start_server(handle_control_http, host="127.0.0.1", port=args.control_port, limit=CONTROL_LINE_LIMIT)
+        control_servers.append(server)
+
+def stop_control_servers():
+    for server in control_servers:
+        server.close()
+    control_servers.clear()
+    if args.control_socket and os.path.exists(args.control_socket):
+        try:
+            os.unlink(args.control_socket)
+        except OSError:
+            pass
 
 def play_video():
     file_path = filedialog.askopenfilename(filetypes=[("Video Files", "*.mp4 *.mkv *.webm *.vob *.avi *.wmv *.m2ts *.ts *.m4v")])
@@ -530,12 +3445,24 @@ def show_help():
                                     "This disregards shuffle settings for the playlist.",
         "Dir Select Not Random": "Plays songs from the selected directory in the correct order. "
                                  "This ensures that files are played sequentially as they appear in the directory.",
+        "Watch Dir": "Watches the current music directory and adds or removes songs as files are added, "
+                     "moved or deleted, without rescanning the whole directory. Linux only.",
+        "Normalize": "Evens out the volume between songs. Each song's loudness is measured once in the background "
+                     "and stored, then played back at a gain that brings it to the same level. Needs NumPy and FFmpeg.",
+        "Skip Duplicates": "Finds songs that are byte-for-byte copies of each other, even in different folders, and only "
+                           "plays one of them when shuffling. Dropping a folder on the playlist also leaves out copies.",
+        "Smart Shuffle": "Picks the next song from the ones that sound most like the current one, judged by brightness, "
+                         "loudness, dynamics and tempo, instead of from the whole library. Songs are analyzed once in "
+                         "the background. Needs NumPy and FFmpeg.",
         "Play Video": "Plays a video media file using FFmpeg. This is the only button that interacts with videos. "
                       "You can use [Right-Click Mouse drag] to seek and [P] for Pause during video playback.",
         "Look Up Currently Playing Song": "Displays information about the currently playing song, "
                                           "such as title, artist, duration, etc.",
         "Play": "Starts playing music from the saved playlist in JSON order. "
-                "This button initiates playback based on the order of songs stored in your playlist file."
+                "This button initiates playback based on the order of songs stored in your playlist file.",
+        "Diagnostics": "Shows how long the player's busy spots take: the once-a-second update, redrawing the playlist, "
+                       "skip to sound, directory scans and settings writes. Recording is off unless you turn it on "
+                       "there or start with --instrument. Save JSON and Save Prometheus write the numbers to Documents."
     }
 
     help_text = tk.Text(help_window, bg="#1e1e1e", fg="lightgray", font=font_style_label, wrap=tk.WORD, height=50)
@@ -553,13 +3480,68 @@ def show_help():
     back_button = tk.Button(help_window, text="Main", command=help_window.destroy, bg="#3a3a3a", fg="white", font=font_style_button)
     back_button.pack(pady=10)
 
+def dump_metrics(prometheus):
+    try:
+        path = os.path.join(DOCUMENTS_DIR, "player_metrics.prom" if prometheus else "player_metrics.json")
+        write_file_atomically(path, metrics_prometheus() if prometheus else json.dumps(metrics_snapshot(), indent=2))
+        update_status_label(f"Metrics saved to {path}")
+    except Exception as e:
+        update_error_label(f"Error saving metrics: {str(e)}")
+        log_to_file(f"Error saving metrics: {str(e)}")
+
+def toggle_instrumentation(button):
+    global instrumentation_enabled
+    instrumentation_enabled = not instrumentation_enabled
+    button.config(text="Recording: On" if instrumentation_enabled else "Recording: Off", fg="green" if instrumentation_enabled else "red")
+    update_status_label("Instrumentation " + ("Enabled" if instrumentation_enabled else "Disabled"))
+
+def format_metrics():
+    lines = [f"{'metric':<17}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+    for name, summary in metrics_snapshot().items():
+        values = "".join(f"{summary[key]:>10.3f}" if key in summary else f"{'-':>10}" for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms"))
+        lines.append(f"{name:<17}{summary['count']:>8}{values}")
+    return "\n".join(lines)
+
+def show_diagnostics():
+    diagnostics_window = tk.Toplevel()
+    diagnostics_window.title("Diagnostics")
+    diagnostics_window.configure(bg="#1e1e1e")
+
+    font_style_button = ("Courier", 12, "bold")
+
+    metrics_label = tk.Label(diagnostics_window, text="", bg="#1e1e1e", fg="lightgray", font=("Courier", 10), justify=tk.LEFT, anchor="w")
+    metrics_label.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+
+    def refresh():
+        if metrics_label.winfo_exists():
+            metrics_label.config(text=format_metrics())
+            diagnostics_window.after(1000, refresh)
+
+    buttons_frame = tk.Frame(diagnostics_window, bg="#1e1e1e")
+    buttons_frame.pack(pady=10)
+    recording_button = tk.Button(buttons_frame, text="Recording: On" if instrumentation_enabled else "Recording: Off",
+                                 fg="green" if instrumentation_enabled else "red", bg="#3a3a3a", font=font_style_button)
+    recording_button.config(command=lambda: toggle_instrumentation(recording_button))
+    recording_button.pack(side=tk.LEFT, padx=2)
+    reset_button = tk.Button(buttons_frame, text="Reset", bg="#3a3a3a", fg="white", font=font_style_button,
+                             command=lambda: [histogram.reset() for histogram in latency_histograms.values()])
+    reset_button.pack(side=tk.LEFT, padx=2)
+    json_button = tk.Button(buttons_frame, text="Save JSON", bg="#3a3a3a", fg="white", font=font_style_button, command=lambda: dump_metrics(False))
+    json_button.pack(side=tk.LEFT, padx=2)
+    prometheus_button = tk.Button(buttons_frame, text="Save Prometheus", bg="#3a3a3a", fg="white", font=font_style_button, command=lambda: dump_metrics(True))
+    prometheus_button.pack(side=tk.LEFT, padx=2)
+    back_button = tk.Button(buttons_frame, text="Main", command=diagnostics_window.destroy, bg="#3a3a3a", fg="white", font=font_style_button)
+    back_button.pack(side=tk.LEFT, padx=2)
+
+    refresh()
+
 def look_up_currently_playing_song():
     global current_song
     if current_song:
         try:
-            audio = MP3(current_song, ID3=EasyID3)
-            song_name = audio.get('title', [os.path.basename(current_song).rsplit('.', 1)[0]])[0]
-            band_name = audio.get('artist', [''])[0]
+            tags = get_track_metadata(current_song) or {}
+            song_name = tags.get('title') or os.path.basename(current_song).rsplit('.', 1)[0]
+            band_name = tags.get('artist') or ''
         except Exception as e:
             song_name = os.path.basename(current_song).rsplit('.', 1)[0]
             band_name = ''
@@ -567,51 +3549,13 @@ def look_up_currently_playing_song():
             log_to_file(f"Error extracting metadata: {str(e)}")
         
         search_query = f"{band_name} {song_name} song"
+        import webbrowser
         webbrowser.open(f"https://www.google.com/search?q={search_query}")
 
 def play_first_song():
     global playlist
     if playlist:
-        asyncio.run(play_song(playlist[0]))
-
-# Initialize GUI with TkinterDnD for drag-and-drop
-root = TkinterDnD.Tk()
-root.title(ORIGINAL_TITLE)
-root.configure(bg="#1e1e1e")
-
-font_style_title = ("Courier", 14, "bold")
-font_style_label = ("Courier", 11)
-font_style_button = ("Courier", 10, "bold")
-
-status_label = tk.Label(root, text=ORIGINAL_TITLE, bg="#1e1e1e", fg="lightgray", font=font_style_title)
-status_label.pack(pady=5)
-info_label = tk.Label(root, text="", bg="#1e1e1e", fg="lightgray", font=font_style_label)
-info_label.pack(pady=5)
-
-buttons_frame1 = tk.Frame(root, bg="#3a3a3a")
-buttons_frame1.pack(fill=tk.X, pady=5)
-buttons_frame2 = tk.Frame(root, bg="#3a3a3a")
-buttons_frame2.pack(fill=tk.X, pady=5)
-
-pause_button = tk.Button(buttons_frame1, text="Pause: Off", bg="#3a3a3a", fg="white", font=font_style_button)
-unpause_button = tk.Button(buttons_frame1, text="Unpause", bg="#3a3a3a", fg="white", font=font_style_button)
-skip_button = tk.Button(buttons_frame1, text="Skip", bg="#3a3a3a", fg="white", font=font_style_button)
-change_dir_button = tk.Button(buttons_frame1, text="Change Dir", bg="#3a3a3a", fg="white", font=font_style_button)
-prev_button = tk.Button(buttons_frame1, text="Prev", bg="#3a3a3a", fg="white", font=font_style_button)
-save_button = tk.Button(buttons_frame1, text="Save", bg="#3a3a3a", fg="white", font=font_style_button)
-clear_button = tk.Button(buttons_frame1, text="Clear Playlist", bg="#3a3a3a", fg="white", font=font_style_button)
-shuffle_button = tk.Button(buttons_frame1, text="Shuffle Playlist", bg="#3a3a3a", fg="white", font=font_style_button)
-repeat_button = tk.Button(buttons_frame1, text="Repeat: Off", bg="#3a3a3a", fg="white", font=font_style_button)
-
-save_playlist_button = tk.Button(buttons_frame2, text="Save Playlist to File", bg="#3a3a3a", fg="white", font=font_style_button)
-load_playlist_button = tk.Button(buttons_frame2, text="Load Playlist from File", bg="#3a3a3a", fg="white", font=font_style_button)
-playlist_only_button = tk.Button(buttons_frame2, text="Playlist Only: Off", bg="#3a3a3a", fg="white", font=font_style_button)
-playlist_only_not_random_button = tk.Button(buttons_frame2, text="Playlist Only Not Random: Off", bg="#3a3a3a", fg="white", font=font_style_button)
-dir_select_not_random_button = tk.Button(buttons_frame2, text="Dir Select Not Random: Off", bg="#3a3a3a", fg="white", font=font_style_button)
-play_video_button = tk.Button(buttons_frame2, text="Play Video", bg="#3a3a3a", fg="white", font=font_style_button)
-lookup_button = tk.Button(buttons_frame2, text="Look Up Currently Playing Song", bg="#3a3a3a", fg="white", font=font_style_button)
-play_button = tk.Button(buttons_frame2, text="Play", bg="#3a3a3a", fg="white", font=font_style_button)
-help_button = tk.Button(buttons_frame2, text="Help", bg="#3a3a3a", fg="white", font=font_style_button)
+        run_async(play_song(track_path(playlist[0])))
 
 def make_text_green(button):
     button.config(fg='green')
@@ -626,7 +3570,7 @@ def handle_unpause():
 
 def handle_skip():
     make_text_green(skip_button)
-    asyncio.run(skip_song())
+    run_async(user_skip_song())
 
 def handle_change_dir():
     make_text_green(change_dir_button)
@@ -672,6 +3616,22 @@ def handle_dir_select_not_random():
     make_text_green(dir_select_not_random_button)
     toggle_dir_select_not_random_mode()
 
+def handle_watch_library():
+    make_text_green(watch_library_button)
+    toggle_watch_library_mode()
+
+def handle_normalize():
+    make_text_green(normalize_button)
+    toggle_normalize_mode()
+
+def handle_skip_duplicates():
+    make_text_green(skip_duplicates_button)
+    toggle_skip_duplicates_mode()
+
+def handle_smart_shuffle():
+    make_text_green(smart_shuffle_button)
+    toggle_smart_shuffle_mode()
+
 def handle_play_video():
     make_text_green(play_video_button)
     play_video()
@@ -688,111 +3648,392 @@ def handle_help():
     make_text_green(help_button)
     show_help()
 
-pause_button.config(command=handle_pause)
-unpause_button.config(command=handle_unpause)
-skip_button.config(command=handle_skip)
-change_dir_button.config(command=handle_change_dir)
-prev_button.config(command=handle_prev)
-save_button.config(command=handle_save)
-clear_button.config(command=handle_clear)
-shuffle_button.config(command=handle_shuffle)
-repeat_button.config(command=handle_repeat)
-save_playlist_button.config(command=handle_save_playlist)
-load_playlist_button.config(command=handle_load_playlist)
-playlist_only_button.config(command=handle_playlist_only)
-playlist_only_not_random_button.config(command=handle_playlist_only_not_random)
-dir_select_not_random_button.config(command=handle_dir_select_not_random)
-play_video_button.config(command=handle_play_video)
-lookup_button.config(command=handle_lookup)
-play_button.config(command=handle_play)
-help_button.config(command=handle_help)
-
-pause_button.pack(side=tk.LEFT, padx=2, pady=2)
-unpause_button.pack(side=tk.LEFT, padx=2, pady=2)
-skip_button.pack(side=tk.LEFT, padx=2, pady=2)
-change_dir_button.pack(side=tk.LEFT, padx=2, pady=2)
-prev_button.pack(side=tk.LEFT, padx=2, pady=2)
-save_button.pack(side=tk.LEFT, padx=2, pady=2)
-clear_button.pack(side=tk.LEFT, padx=2, pady=2)
-shuffle_button.pack(side=tk.LEFT, padx=2, pady=2)
-repeat_button.pack(side=tk.LEFT, padx=2, pady=2)
-
-save_playlist_button.pack(side=tk.LEFT, padx=2, pady=2)
-load_playlist_button.pack(side=tk.LEFT, padx=2, pady=2)
-playlist_only_button.pack(side=tk.LEFT, padx=2, pady=2)
-playlist_only_not_random_button.pack(side=tk.LEFT, padx=2, pady=2)
-dir_select_not_random_button.pack(side=tk.LEFT, padx=2, pady=2)
-play_video_button.pack(side=tk.LEFT, padx=2, pady=2)
-lookup_button.pack(side=tk.LEFT, padx=2, pady=2)
-play_button.pack(side=tk.LEFT, padx=2, pady=2)
-help_button.pack(side=tk.LEFT, padx=2, pady=2)
-
-playing_frame = tk.Frame(root, bg="#2e2e2e", bd=2, relief=tk.GROOVE)
-playing_frame.pack(pady=10, fill=tk.X)
-
-playing_label = tk.Label(playing_frame, text="", bg="#2e2e2e", fg="lightgray", font=font_style_label, anchor="w")
-playing_label.pack(fill=tk.X)
-
-playlist_frame = tk.Frame(root, bg="#1e1e1e")
-playlist_frame.pack(pady=10, fill=tk.X, expand=True)
-
-scrollbar_y = tk.Scrollbar(playlist_frame, orient='vertical')
-scrollbar_y.pack(side=tk.RIGHT, fill=tk.Y)
-
-playlist_listbox = tk.Listbox(playlist_frame, height=20, yscrollcommand=scrollbar_y.set, bg="#2e2e2e", fg="lightgray", font=("Courier", 10))
-playlist_listbox.bind('<<ListboxSelect>>', play_selected_song)
-playlist_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-
-scrollbar_y['command'] = playlist_listbox.yview
-playlist_listbox.config(yscrollcommand=scrollbar_y.set)
-
-volume_frame = tk.Frame(root, bg="#1e1e1e")
-volume_frame.pack(pady=10)
-
-volume_label = tk.Label(volume_frame, text="Volume: 50%", bg="#1e1e1e", fg="lightgray", font=font_style_label)
-volume_label.pack()
-
-volume_buttons_frame = tk.Frame(volume_frame, bg="#1e1e1e")
-volume_buttons_frame.pack()
-
-volume_down_button = tk.Button(volume_buttons_frame, text="-", command=decrease_volume, bg="#3a3a3a", fg="white", font=font_style_button)
-volume_down_button.pack(side=tk.LEFT, padx=5)
-
-volume_up_button = tk.Button(volume_buttons_frame, text="+", command=increase_volume, bg="#3a3a3a", fg="white", font=font_style_button)
-volume_up_button.pack(side=tk.LEFT, padx=5)
-
-error_label_frame = tk.Frame(root, bg="#1e1e1e")
-error_label_frame.pack(fill=tk.X, pady=5, padx=5)
-
-error_label = tk.Label(error_label_frame, text="", bg="#1e1e1e", fg="yellow", font=("Courier", 10, "bold"), anchor="w")
-error_label.pack(side=tk.LEFT)
-
-search_frame = tk.Frame(root, bg="#1e1e1e")
-search_frame.pack(pady=5, fill=tk.X)
-search_label = tk.Label(search_frame, text="Search Playlist:", bg="#1e1e1e", fg="lightgray", font=font_style_label)
-search_label.pack(side=tk.LEFT, padx=5)
-search_entry = tk.Entry(search_frame, bg="#2e2e2e", fg="lightgray", font=font_style_label)
-search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
-search_entry.bind('<KeyRelease>', search_playlist)
-
-app_label = tk.Label(root, text="randomly play from your own local music library", bg="#1e1e1e", fg="lightgray", font=("Courier", 10))
-app_label.pack(pady=5)
-
-root.protocol("WM_DELETE_WINDOW", on_close)
-
-playlist_listbox.drop_target_register(DND_FILES)
-playlist_listbox.dnd_bind('<<Drop>>', drop)
-
-load_settings()
-asyncio.run(auto_load_dir())
-update_labels()
-root.mainloop()
+def handle_diagnostics():
+    make_text_green(diagnostics_button)
+    show_diagnostics()
+
+# The window and everything in it; headless mode never calls this, so Tk is
+# only imported when there is a window to show
+def build_gui():
+    global tk, tkfont, filedialog, messagebox, root, status_label, info_label, playing_label, volume_label, error_label
+    global pause_button, unpause_button, skip_button, change_dir_button, prev_button, save_button, clear_button, shuffle_button, repeat_button
+    global save_playlist_button, load_playlist_button, playlist_only_button, playlist_only_not_random_button, dir_select_not_random_button
+    global watch_library_button, normalize_button, skip_duplicates_button, smart_shuffle_button, play_video_button, lookup_button, play_button, help_button, diagnostics_button
+    global playlist_listbox, scrollbar_y, playlist_line_height, search_entry
+    import tkinter as tk
+    import tkinter.font as tkfont
+    from tkinter import filedialog, messagebox
+    from tkinterdnd2 import TkinterDnD, DND_FILES
+
+    # Initialize GUI with TkinterDnD for drag-and-drop
+    root = TkinterDnD.Tk()
+    root.title(ORIGINAL_TITLE)
+    root.configure(bg="#1e1e1e")
+
+    font_style_title = ("Courier", 14, "bold")
+    font_style_label = ("Courier", 11)
+    font_style_button = ("Courier", 10, "bold")
+
+    status_label = tk.Label(root, text=ORIGINAL_TITLE, bg="#1e1e1e", fg="lightgray", font=font_style_title)
+    status_label.pack(pady=5)
+    info_label = tk.Label(root, text="", bg="#1e1e1e", fg="lightgray", font=font_style_label)
+    info_label.pack(pady=5)
+
+    buttons_frame1 = tk.Frame(root, bg="#3a3a3a")
+    buttons_frame1.pack(fill=tk.X, pady=5)
+    buttons_frame2 = tk.Frame(root, bg="#3a3a3a")
+    buttons_frame2.pack(fill=tk.X, pady=5)
+
+    pause_button = tk.Button(buttons_frame1, text="Pause: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    unpause_button = tk.Button(buttons_frame1, text="Unpause", bg="#3a3a3a", fg="white", font=font_style_button)
+    skip_button = tk.Button(buttons_frame1, text="Skip", bg="#3a3a3a", fg="white", font=font_style_button)
+    change_dir_button = tk.Button(buttons_frame1, text="Change Dir", bg="#3a3a3a", fg="white", font=font_style_button)
+    prev_button = tk.Button(buttons_frame1, text="Prev", bg="#3a3a3a", fg="white", font=font_style_button)
+    save_button = tk.Button(buttons_frame1, text="Save", bg="#3a3a3a", fg="white", font=font_style_button)
+    clear_button = tk.Button(buttons_frame1, text="Clear Playlist", bg="#3a3a3a", fg="white", font=font_style_button)
+    shuffle_button = tk.Button(buttons_frame1, text="Shuffle Playlist", bg="#3a3a3a", fg="white", font=font_style_button)
+    repeat_button = tk.Button(buttons_frame1, text="Repeat: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+
+    save_playlist_button = tk.Button(buttons_frame2, text="Save Playlist to File", bg="#3a3a3a", fg="white", font=font_style_button)
+    load_playlist_button = tk.Button(buttons_frame2, text="Load Playlist from File", bg="#3a3a3a", fg="white", font=font_style_button)
+    playlist_only_button = tk.Button(buttons_frame2, text="Playlist Only: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    playlist_only_not_random_button = tk.Button(buttons_frame2, text="Playlist Only Not Random: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    dir_select_not_random_button = tk.Button(buttons_frame2, text="Dir Select Not Random: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    watch_library_button = tk.Button(buttons_frame2, text="Watch Dir: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    normalize_button = tk.Button(buttons_frame2, text="Normalize: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    skip_duplicates_button = tk.Button(buttons_frame2, text="Skip Duplicates: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    smart_shuffle_button = tk.Button(buttons_frame2, text="Smart Shuffle: Off", bg="#3a3a3a", fg="white", font=font_style_button)
+    play_video_button = tk.Button(buttons_frame2, text="Play Video", bg="#3a3a3a", fg="white", font=font_style_button)
+    lookup_button = tk.Button(buttons_frame2, text="Look Up Currently Playing Song", bg="#3a3a3a", fg="white", font=font_style_button)
+    play_button = tk.Button(buttons_frame2, text="Play", bg="#3a3a3a", fg="white", font=font_style_button)
+    help_button = tk.Button(buttons_frame2, text="Help", bg="#3a3a3a", fg="white", font=font_style_button)
+    diagnostics_button = tk.Button(buttons_frame2, text="Diagnostics", bg="#3a3a3a", fg="white", font=font_style_button)
+
+    pause_button.config(command=handle_pause)
+    unpause_button.config(command=handle_unpause)
+    skip_button.config(command=handle_skip)
+    change_dir_button.config(command=handle_change_dir)
+    prev_button.config(command=handle_prev)
+    save_button.config(command=handle_save)
+    clear_button.config(command=handle_clear)
+    shuffle_button.config(command=handle_shuffle)
+    repeat_button.config(command=handle_repeat)
+    save_playlist_button.config(command=handle_save_playlist)
+    load_playlist_button.config(command=handle_load_playlist)
+    playlist_only_button.config(command=handle_playlist_only)
+    playlist_only_not_random_button.config(command=handle_playlist_only_not_random)
+    dir_select_not_random_button.config(command=handle_dir_select_not_random)
+    watch_library_button.config(command=handle_watch_library)
+    normalize_button.config(command=handle_normalize)
+    skip_duplicates_button.config(command=handle_skip_duplicates)
+    smart_shuffle_button.config(command=handle_smart_shuffle)
+    play_video_button.config(command=handle_play_video)
+    lookup_button.config(command=handle_lookup)
+    play_button.config(command=handle_play)
+    help_button.config(command=handle_help)
+    diagnostics_button.config(command=handle_diagnostics)
+
+    pause_button.pack(side=tk.LEFT, padx=2, pady=2)
+    unpause_button.pack(side=tk.LEFT, padx=2, pady=2)
+    skip_button.pack(side=tk.LEFT, padx=2, pady=2)
+    change_dir_button.pack(side=tk.LEFT, padx=2, pady=2)
+    prev_button.pack(side=tk.LEFT, padx=2, pady=2)
+    save_button.pack(side=tk.LEFT, padx=2, pady=2)
+    clear_button.pack(side=tk.LEFT, padx=2, pady=2)
+    shuffle_button.pack(side=tk.LEFT, padx=2, pady=2)
+    repeat_button.pack(side=tk.LEFT, padx=2, pady=2)
+
+    save_playlist_button.pack(side=tk.LEFT, padx=2, pady=2)
+    load_playlist_button.pack(side=tk.LEFT, padx=2, pady=2)
+    playlist_only_button.pack(side=tk.LEFT, padx=2, pady=2)
+    playlist_only_not_random_button.pack(side=tk.LEFT, padx=2, pady=2)
+    dir_select_not_random_button.pack(side=tk.LEFT, padx=2, pady=2)
+    watch_library_button.pack(side=tk.LEFT, padx=2, pady=2)
+    normalize_button.pack(side=tk.LEFT, padx=2, pady=2)
+    skip_duplicates_button.pack(side=tk.LEFT, padx=2, pady=2)
+    smart_shuffle_button.pack(side=tk.LEFT, padx=2, pady=2)
+    play_video_button.pack(side=tk.LEFT, padx=2, pady=2)
+    lookup_button.pack(side=tk.LEFT, padx=2, pady=2)
+    play_button.pack(side=tk.LEFT, padx=2, pady=2)
+    help_button.pack(side=tk.LEFT, padx=2, pady=2)
+    diagnostics_button.pack(side=tk.LEFT, padx=2, pady=2)
+
+    playing_frame = tk.Frame(root, bg="#2e2e2e", bd=2, relief=tk.GROOVE)
+    playing_frame.pack(pady=10, fill=tk.X)
+
+    playing_label = tk.Label(playing_frame, text="", bg="#2e2e2e", fg="lightgray", font=font_style_label, anchor="w")
+    playing_label.pack(fill=tk.X)
+
+    playlist_frame = tk.Frame(root, bg="#1e1e1e")
+    playlist_frame.pack(pady=10, fill=tk.X, expand=True)
+
+    scrollbar_y = tk.Scrollbar(playlist_frame, orient='vertical')
+    scrollbar_y.pack(side=tk.RIGHT, fill=tk.Y)
+
+    playlist_listbox = tk.Listbox(playlist_frame, height=PLAYLIST_VISIBLE_ROWS, bg="#2e2e2e", fg="lightgray", font=("Courier", 10))
+    playlist_listbox.bind('<<ListboxSelect>>', play_selected_song)
+    playlist_listbox.bind('<MouseWheel>', on_playlist_mousewheel)
+    playlist_listbox.bind('<Button-4>', on_playlist_mousewheel)
+    playlist_listbox.bind('<Button-5>', on_playlist_mousewheel)
+    playlist_listbox.bind('<Configure>', lambda event: update_playlist())
+    playlist_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+    playlist_line_height = tkfont.Font(font=playlist_listbox.cget("font")).metrics("linespace") + 1
+
+    scrollbar_y['command'] = scroll_playlist
+
+    volume_frame = tk.Frame(root, bg="#1e1e1e")
+    volume_frame.pack(pady=10)
+
+    volume_label = tk.Label(volume_frame, text="Volume: 50%", bg="#1e1e1e", fg="lightgray", font=font_style_label)
+    volume_label.pack()
+
+    volume_buttons_frame = tk.Frame(volume_frame, bg="#1e1e1e")
+    volume_buttons_frame.pack()
+
+    volume_down_button = tk.Button(volume_buttons_frame, text="-", command=decrease_volume, bg="#3a3a3a", fg="white", font=font_style_button)
+    volume_down_button.pack(side=tk.LEFT, padx=5)
+
+    volume_up_button = tk.Button(volume_buttons_frame, text="+", command=increase_volume, bg="#3a3a3a", fg="white", font=font_style_button)
+    volume_up_button.pack(side=tk.LEFT, padx=5)
+
+    error_label_frame = tk.Frame(root, bg="#1e1e1e")
+    error_label_frame.pack(fill=tk.X, pady=5, padx=5)
+
+    error_label = tk.Label(error_label_frame, text="", bg="#1e1e1e", fg="yellow", font=("Courier", 10, "bold"), anchor="w")
+    error_label.pack(side=tk.LEFT)
+
+    search_frame = tk.Frame(root, bg="#1e1e1e")
+    search_frame.pack(pady=5, fill=tk.X)
+    search_label = tk.Label(search_frame, text="Search Playlist:", bg="#1e1e1e", fg="lightgray", font=font_style_label)
+    search_label.pack(side=tk.LEFT, padx=5)
+    search_entry = tk.Entry(search_frame, bg="#2e2e2e", fg="lightgray", font=font_style_label)
+    search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+    search_entry.bind('<KeyRelease>', search_playlist)
+
+    app_label = tk.Label(root, text="randomly play from your own local music library", bg="#1e1e1e", fg="lightgray", font=("Courier", 10))
+    app_label.pack(pady=5)
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
+
+    playlist_listbox.drop_target_register(DND_FILES)
+    playlist_listbox.dnd_bind('<<Drop>>', drop)
+
+BENCHMARK_DRAWS = 10000
+BENCHMARK_SCROLLS = 100
+# Below this many tracks the store's fixed costs can outweigh the paths it saves
+BENCHMARK_MEMORY_MIN_TRACKS = 1000
+BENCHMARK_SEARCH_TERMS = ("track 00", "album 00042", "07 - track", "zzz")
+
+def generate_music_tree(top, count):
+    for index in range(count):
+        album = index // 100
+        directory = os.path.join(top, f"Artist {album // 50:05d}", f"Album {album:05d}")
+        if index % 100 == 0:
+            os.makedirs(directory)
+        open(os.path.join(directory, f"{index % 100:02d} - Track {index:07d}.mp3"), 'wb').close()
+
+# Short silent WAVs, for checks that need the mixer to actually load a track
+def generate_silent_tracks(top, count):
+    import wave
+    os.makedirs(top)
+    for index in range(count):
+        with wave.open(os.path.join(top, f"{index:02d} - Silence.wav"), 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(8000)
+            f.writeframes(bytes(1600))
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return round(time.perf_counter() - start, 6)
+
+def time_first_batch(directory):
+    start = time.perf_counter()
+    first = []
+    scan_library(directory, lambda ids: first or first.append(time.perf_counter() - start))
+    return round(first[0], 6) if first else None
+
+# Bytes per track held by a TrackStore of these tracks, and by the plain list
+# of path strings it replaces. Sizes are added up object by object, so the
+# player's background threads do not skew the numbers.
+def measure_track_memory(tracks):
+    paths = [track_path(track) for track in tracks]
+    store = TrackStore()
+    for path in paths:
+        store.intern(path)
+    parts = [store.dir_ids, store.dirs, store.dir_tracks, store.names, store.name_offsets, store.track_dirs, store.slots, store.children]
+    parts += itertools.chain(store.dirs, store.dir_tracks, store.children, store.children.values())
+    store_bytes = sum(map(sys.getsizeof, parts))
+    path_bytes = sys.getsizeof(paths) + sum(map(sys.getsizeof, paths))
+    return {"track_store": round(store_bytes / len(paths), 1), "path_list": round(path_bytes / len(paths), 1)}
+
+def time_selection(draws):
+    global skip_count
+    start = time.perf_counter()
+    for _ in range(draws):
+        choose_next_song()
+        skip_count += 1
+    return round((time.perf_counter() - start) / draws * 1e6, 3)
+
+# Points every file the player writes at a throwaway directory and forgets the
+# previous run's library, so each size starts from the same cold state
+def reset_benchmark_state(directory):
+    global LOG_FILE, SETTINGS_FILE, LIBRARY_DB_FILE, PLAYLIST_FILE, FEATURES_FILE, PLAY_LOG_FILE, DOCUMENTS_DIR, playlist_journal, playlist_export
+    global track_store, search_index, song_files, playlist, playback_history, play_stats, current_song, metadata_conn, metadata_generation
+    search_executor.submit(int).result()
+    playback_history.close()
+    play_stats.close()
+    metadata_generation += 1
+    if metadata_conn is not None:
+        metadata_conn.close()
+        metadata_conn = None
+    LOG_FILE = os.path.join(directory, "script_log.txt")
+    setup_logging()
+    SETTINGS_FILE = os.path.join(directory, "music_player_settings.json")
+    LIBRARY_DB_FILE = os.path.join(directory, "music_library.db")
+    PLAYLIST_FILE = os.path.join(directory, "music_playlist.json")
+    FEATURES_FILE = os.path.join(directory, "music_features.f32")
+    PLAY_LOG_FILE = os.path.join(directory, "music_plays.log")
+    DOCUMENTS_DIR = os.path.join(directory, "Documents")
+    os.makedirs(DOCUMENTS_DIR)
+    playlist_journal = PlaylistJournal(PLAYLIST_FILE)
+    playlist_journal.attach(array('I'), None)
+    playlist_export = PlaylistJournal(os.path.join(DOCUMENTS_DIR, 'playlist.json'))
+    track_store = TrackStore()
+    search_index = SearchIndex()
+    song_files = array('I')
+    playlist = array('I')
+    playback_history = PlaybackHistory()
+    play_stats = PlayStats()
+    current_song = None
+    set_shuffle_seed(0)
+
+def benchmark_size(count, directory):
+    global metadata_generation, playlist_only_mode, playlist_only_not_random_mode, dir_select_not_random_mode
+    reset_benchmark_state(directory)
+    tree = os.path.join(directory, "Music")
+    results = {"tracks": count, "generate_tree_s": time_call(generate_music_tree, tree, count)}
+
+    results["load_songs_cold_s"] = time_call(event_loop.run_until_complete, load_songs_from_directory(tree))
+    metadata_generation += 1
+    results["load_songs_warm_s"] = time_call(event_loop.run_until_complete, load_songs_from_directory(tree))
+    metadata_generation += 1
+    results["first_batch_s"] = time_first_batch(tree)
+    memory = results["bytes_per_track"] = measure_track_memory(song_files)
+    assert count < BENCHMARK_MEMORY_MIN_TRACKS or memory["track_store"] < memory["path_list"], f"Track store takes {memory['track_store']} bytes per track, a path list {memory['path_list']}"
+    results["process_directory_s"] = time_call(event_loop.run_until_complete, process_directory(tree))
+
+    selection = {}
+    for name, only, not_random, dir_not_random in (("library_shuffle", False, False, False), ("library_in_order", False, False, True),
+                                                   ("playlist_shuffle", True, False, False), ("playlist_in_order", True, True, False)):
+        playlist_only_mode, playlist_only_not_random_mode, dir_select_not_random_mode = only, not_random, dir_not_random
+        selection[name] = time_selection(BENCHMARK_DRAWS)
+    playlist_only_mode = playlist_only_not_random_mode = dir_select_not_random_mode = False
+    results["selection_us_per_draw"] = selection
+
+    if root is not None:
+        results["update_playlist_s"] = time_call(playlist_changed)
+        results["scroll_playlist_s"] = round(time_call(lambda: [scroll_playlist("scroll", 1, "pages") for _ in range(BENCHMARK_SCROLLS)]) / BENCHMARK_SCROLLS, 6)
+    else:
+        results["update_playlist_s"] = results["scroll_playlist_s"] = None
+
+    search_executor.submit(int).result()
+    index = SearchIndex()
+    results["search_index_build_s"] = time_call(lambda: (index.sync("library", array('I', song_files)), index.sync("playlist", array('I', playlist))))
+    snapshot = array('I', playlist)
+    results["search_playlist_s"] = {term: time_call(find_search_matches, index, term, snapshot) for term in BENCHMARK_SEARCH_TERMS}
+
+    results["save_settings_s"] = time_call(lambda: (save_settings(), flush_settings_now()))
+    results["save_playlist_edit_s"] = time_call(lambda: (edit_playlist("add", playlist[0]), flush_settings_now()))
+    results["load_settings_s"] = time_call(load_settings)
+
+    # Changing directory must not play the pick prefetched from the old one
+    before, after = os.path.join(directory, "Before"), os.path.join(directory, "After")
+    generate_silent_tracks(before, 10)
+    generate_silent_tracks(after, 10)
+    event_loop.run_until_complete(load_songs_from_directory(before))
+    results["change_dir_s"] = time_call(event_loop.run_until_complete, load_songs_from_directory(after))
+    assert current_song is not None and current_song.startswith(after + os.sep), f"Played {current_song} after changing to {after}"
+    metadata_generation += 1
+    library_pass_executor.submit(int).result()
+    flush_settings_now()
+    return results
+
+# Runs with a dummy SDL audio driver, so no sound card is needed. The table
+# rendering numbers need a display; without one they are reported as null.
+def run_benchmark(sizes):
+    global root
+    init_audio()
+    if sys.platform == "win32" or os.environ.get("DISPLAY"):
+        try:
+            build_gui()
+            root.withdraw()
+        except Exception as e:
+            root = None
+            print(f"Skipping playlist rendering benchmarks: {str(e)}", file=sys.stderr)
+    report = {"python": sys.version.split()[0], "platform": sys.platform, "draws": BENCHMARK_DRAWS, "sizes": []}
+    with contextlib.redirect_stdout(sys.stderr):
+        for count in [int(size) for size in sizes.split(",")]:
+            with tempfile.TemporaryDirectory(prefix="shuffle-benchmark-") as directory:
+                report["sizes"].append(benchmark_size(count, directory))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+def run_gui():
+    build_gui()
+    # Map the window before the mixer and settings load so it appears straight away
+    root.update()
+    mark_startup("window")
+    init_audio()
+    load_settings()
+    playback_history.load()
+    mark_startup("settings")
+    run_async(start_control_servers(), "Error starting control server")
+    run_async(auto_load_dir(), "Error loading music directory")
+    pump_event_loop()
+    pump_music_events()
+    update_labels()
+    root.mainloop()
+
+def run_headless():
+    try:
+        event_loop.add_signal_handler(signal.SIGTERM, event_loop.stop)
+    except (NotImplementedError, AttributeError):
+        pass
+    init_audio()
+    load_settings()
+    playback_history.load()
+    mark_startup("settings")
+    run_async(start_control_servers(), "Error starting control server")
+    run_async(auto_load_dir(), "Error loading music directory")
+    pump_music_events()
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        on_close()
 
 if __name__ == "__main__":
+    mark_startup("definitions")
+    setup_logging()
     try:
         check_python_version()
-        check_pygame_installation()
-        check_tkinterdnd2_installation()
     except Exception as e:
         log_to_file(str(e))
         sys.exit(1)
+    if args.check_deps:
+        check_dependencies()
+        sys.exit(0)
+    try:
+        if args.benchmark:
+            run_benchmark(args.benchmark)
+        elif args.headless:
+            run_headless()
+        else:
+            run_gui()
+    except ImportError as e:
+        print_and_flush(f"{e.name} is not installed. Run this script with --check-deps to install missing packages.")
+        log_to_file(f"{e.name} is not installed: {str(e)}")
+        sys.exit(1)